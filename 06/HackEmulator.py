@@ -0,0 +1,329 @@
+import sys
+import os
+import array
+import time
+import hashlib
+
+import MyAssembler
+
+
+RAM_SIZE = 0x8000
+SCREEN = 16384
+KBD = 24576
+
+
+# shorter Python for the computations the assembler has mnemonics for
+aluShortcuts = {
+    "0":    "0",
+    "1":    "1",
+    "-1":   "0xFFFF",
+    "D":    "D",
+    "A":    "{y}",
+    "!D":   "D ^ 0xFFFF",
+    "!A":   "{y} ^ 0xFFFF",
+    "-D":   "-D & 0xFFFF",
+    "-A":   "-{y} & 0xFFFF",
+    "D+1":  "(D + 1) & 0xFFFF",
+    "A+1":  "({y} + 1) & 0xFFFF",
+    "D-1":  "(D - 1) & 0xFFFF",
+    "A-1":  "({y} - 1) & 0xFFFF",
+    "D+A":  "(D + {y}) & 0xFFFF",
+    "D-A":  "(D - {y}) & 0xFFFF",
+    "A-D":  "({y} - D) & 0xFFFF",
+    "D&A":  "D & {y}",
+    "D|A":  "D | {y}"
+}
+aluShortcuts = {MyAssembler.compTable[comp]: expression for comp, expression in aluShortcuts.items()}
+
+
+def alu_expression(bits, y="y"):
+    if bits in aluShortcuts:
+        return aluShortcuts[bits].format(y=y)
+
+    # bits are zx nx zy ny f no, x is the D register and y is either A or M
+    zx, nx, zy, ny, f, no = [(bits >> i) & 1 for i in (5, 4, 3, 2, 1, 0)]
+    x = "0" if zx else "D"
+    if nx:
+        x = "0xFFFF" if zx else f"(~{x} & 0xFFFF)"
+    if zy:
+        y = "0"
+    if ny:
+        y = "0xFFFF" if zy else f"(~{y} & 0xFFFF)"
+    out = f"(({x}) + ({y})) & 0xFFFF" if f else f"({x}) & ({y})"
+    if no:
+        out = f"~({out}) & 0xFFFF"
+    return out
+
+
+def alu_function(bits):
+    return eval(f"lambda y, D: {alu_expression(bits)}")
+
+
+def jump_table(bits):
+    # one entry per 16-bit ALU output, 1 if the jump is taken
+    lt, eq, gt = bits & 4, bits & 2, bits & 1
+    return bytes(1 if (lt and out & 0x8000) or (eq and out == 0) or (gt and out and not out & 0x8000) else 0
+                 for out in range(0x10000))
+
+
+aluFunctions = [alu_function(bits) for bits in range(64)]
+jumpTables = [None] + [jump_table(bits) for bits in range(1, 8)]
+
+
+jumpConditions = [None, "0 < out < 0x8000", "out == 0", "out < 0x8000", "out >= 0x8000", "out != 0", "out == 0 or out >= 0x8000"]
+
+# compiled blocks only depend on the ROM, so emulators loading the same program share them;
+# only the most recently loaded programs are kept, the dict is in order of use
+blockCache = {}
+BLOCK_CACHE_SIZE = 16
+
+
+def to_signed(word):
+    return word - 0x10000 if word & 0x8000 else word
+
+
+def load_program(filePath):
+    if filePath.endswith(".rom"):
+        return MyAssembler.load_rom(filePath)
+    elif filePath.endswith(".asm"):
+        with open(filePath, "r") as file:
+            return array.array('H', MyAssembler.Parser()(file))
+    return MyAssembler.load_hack(filePath)
+
+
+
+class Block:
+    __slots__ = ("run", "length", "halts")
+
+    def __init__(self, run, length, halts):
+        self.run = run
+        self.length = length
+        self.halts = halts
+
+
+
+def find_leaders(rom):
+    # Leaders are the instructions blocks start at: the first one, the targets of jumps
+    # whose target is a constant and the instructions after jumps. Blocks stop at the
+    # next leader, so code that is jumped into isn't compiled into several blocks.
+    leaders = {0}
+    for pc, word in enumerate(rom):
+        if word >= 0x8000 and word & 0x7:
+            if pc > 0 and rom[pc - 1] < 0x8000:
+                leaders.add(rom[pc - 1])
+            leaders.add(pc + 1)
+    return leaders
+
+
+def compile_block(rom, start, leaders=(), maxLength=256):
+    # A block runs from start up to the first unconditional jump or the next leader.
+    # Conditional jumps leave the block early, A-instructions aren't emitted, their
+    # constants are folded into the following instructions instead.
+    # The function returns A, D, the next pc and the number of instructions it ran.
+    lines = []
+    knownA = None
+    pc = start
+    halts = False
+
+    def a():
+        return "A" if knownA == None else str(knownA)
+
+    def m():
+        return "ram[A & 0x7FFF]" if knownA == None else f"ram[{knownA}]"
+
+    while pc < len(rom) and pc - start < maxLength and (pc == start or pc not in leaders):
+        word = rom[pc]
+        pc += 1
+        if word < 0x8000:
+            knownA = word
+            continue
+
+        out = alu_expression((word >> 6) & 0x3F, m() if word & 0x1000 else a())
+        dest, jump = (word >> 3) & 0x7, word & 0x7
+        if jump:
+            # the jump target is the value A had before this instruction
+            target = a()
+            if dest & 4 and knownA == None:
+                lines.append("target = A")
+                target = "target"
+        if jump or dest not in (0b001, 0b010, 0b100):
+            lines.append(f"out = {out}")
+            out = "out"
+        if dest & 1:
+            lines.append(f"{m()} = {out}")
+        if dest & 2:
+            lines.append(f"D = {out}")
+        if dest & 4:
+            lines.append(f"A = {out}")
+            knownA = None
+        if jump == 0x7:
+            halts = dest == 0 and pc >= 2 and rom[pc - 2] == pc - 2
+            lines.append(f"return {a()}, D, {target}, {pc - start}")
+            break
+        elif jump:
+            lines.append(f"if {jumpConditions[jump]}:")
+            lines.append(f"    return {a()}, D, {target}, {pc - start}")
+    else:
+        lines.append(f"return {a()}, D, {pc}, {pc - start}")
+
+    source = f"def block_{start}(A, D, ram):\n" + "".join(f"    {line}\n" for line in lines)
+    namespace = {}
+    exec(source, namespace)
+    return Block(namespace[f"block_{start}"], pc - start, halts)
+
+
+
+class Emulator:
+    def __init__(self, rom=(), compiled=False):
+        self.ram = [0] * RAM_SIZE
+        self.compiled = compiled
+        self.load(rom)
+
+
+    def load(self, rom):
+        self.rom = array.array('H', rom)
+        self.decoded = self.decode(self.rom)
+        self.leaders = find_leaders(self.rom)
+
+        key = hashlib.sha1(self.rom).digest()
+        blocks = blockCache.pop(key, None)
+        if blocks is None:
+            blocks = [None] * len(self.rom)
+        blockCache[key] = blocks
+        while len(blockCache) > BLOCK_CACHE_SIZE:
+            del blockCache[next(iter(blockCache))]
+        self.blocks = blocks
+        self.reset()
+
+
+    def reset(self):
+        self.A = 0
+        self.D = 0
+        self.pc = 0
+        self.cycles = 0
+        self.halted = False
+
+
+    def decode(self, rom):
+        # A-instructions stay plain ints, C-instructions become (alu, useM, dest, jump)
+        # tuples. The jump of an "(END) @END 0;JMP" loop is decoded as None, it halts.
+        decoded = []
+        for pc, word in enumerate(rom):
+            if word < 0x8000:
+                decoded.append(word)
+            elif word & 0x7 == 0x7 and word & 0x38 == 0 and pc > 0 and rom[pc - 1] == pc - 1:
+                decoded.append(None)
+            else:
+                decoded.append((aluFunctions[(word >> 6) & 0x3F], (word >> 12) & 1, (word >> 3) & 0x7, jumpTables[word & 0x7]))
+        return decoded
+
+
+    def run(self, max_cycles=None):
+        if self.compiled:
+            return self.run_blocks(max_cycles)
+        return self.interpret(max_cycles)
+
+
+    def run_blocks(self, max_cycles=None, trace=None):
+        # trace is called with the number of instructions and the next pc after every block
+        blocks = self.blocks
+        rom = self.rom
+        leaders = self.leaders
+        ram = self.ram
+        size = len(blocks)
+        A, D, pc = self.A, self.D, self.pc
+        remaining = max_cycles if max_cycles != None else float("inf")
+
+        n = 0
+        while pc < size:
+            block = blocks[pc]
+            if block is None:
+                block = blocks[pc] = compile_block(rom, pc, leaders)
+            if n + block.length > remaining:
+                break
+            A, D, pc, length = block.run(A, D, ram)
+            n += length
+            if trace is not None:
+                trace(length, pc)
+            if block.halts and length == block.length:
+                self.halted = True
+                break
+
+        self.A, self.D, self.pc = A, D, pc
+        self.cycles += n
+        # a block that doesn't fit into the cycle budget anymore is interpreted
+        if n < remaining and not self.halted and pc < size:
+            n += self.interpret(remaining - n)
+        return n
+
+
+    def interpret(self, max_cycles=None):
+        decoded = self.decoded
+        ram = self.ram
+        size = len(decoded)
+        A, D, pc = self.A, self.D, self.pc
+        remaining = max_cycles if max_cycles != None else float("inf")
+
+        n = 0
+        while n < remaining and pc < size:
+            inst = decoded[pc]
+            n += 1
+            if inst.__class__ is int:
+                A = inst
+                pc += 1
+                continue
+            if inst is None:
+                pc = A
+                self.halted = True
+                break
+
+            alu, useM, dest, jump = inst
+            out = alu(ram[A & 0x7FFF] if useM else A, D)
+            if dest:
+                if dest & 1:
+                    ram[A & 0x7FFF] = out
+                if dest & 2:
+                    D = out
+            # the jump target is the value A had before this instruction
+            if jump is not None and jump[out]:
+                pc = A
+            else:
+                pc += 1
+            if dest & 4:
+                A = out
+
+        self.A, self.D, self.pc = A, D, pc
+        self.cycles += n
+        return n
+
+
+    def step(self):
+        return self.interpret(1)
+
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    flags = dict(arg[2:].split("=", 1) if "=" in arg else (arg[2:], "") for arg in sys.argv[1:] if arg.startswith("--"))
+
+    emulator = Emulator(load_program(args[0]), "compiled" in flags)
+    maxCycles = int(flags["cycles"]) if "cycles" in flags else None
+
+    start = time.perf_counter()
+    cycles = emulator.run(maxCycles)
+    elapsed = time.perf_counter() - start
+
+    status = "halted" if emulator.halted else ("stopped" if emulator.pc < len(emulator.rom) else "ran off the end of the ROM")
+    print(f"{os.path.basename(args[0])}: {status} at pc={emulator.pc} after {cycles} cycles in {elapsed:.2f}s "
+          f"({cycles / elapsed / 1e6 if elapsed else 0:.2f}M instructions/s)")
+
+    # --ram=0-15,256 prints those RAM words
+    for part in flags.get("ram", "").split(","):
+        if part:
+            first, _, last = part.partition("-")
+            for address in range(int(first), int(last or first) + 1):
+                print(f"RAM[{address}] = {to_signed(emulator.ram[address])}")
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
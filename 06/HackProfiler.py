@@ -0,0 +1,142 @@
+import sys
+import os
+import re
+import array
+import time
+
+import MyAssembler
+import HackEmulator
+
+
+# labels the VM translator emits inside functions, everything else without a $ is a function
+comparisonLabel = re.compile(r"(NOT_)?(EQ|GT|LT)\.\d+$")
+
+
+def is_function_label(label):
+    return "$" not in label and not comparisonLabel.match(label)
+
+
+def is_return_label(label):
+    return "$ret." in label
+
+
+def caller_of(label):
+    # return labels are named after the function the call is in
+    return label.split("$ret.")[0]
+
+
+
+class Profiler:
+    def __init__(self, emulator, labels):
+        self.emulator = emulator
+        self.entries = {address: label for label, address in labels.items() if is_function_label(label)}
+        self.returns = {address: caller_of(label) for label, address in labels.items() if is_return_label(label)}
+
+        self.stack = ("<bootstrap>",)
+        self.entryCycles = [0]
+        self.cycles = 0
+        self.exclusive = {}
+        self.inclusive = {}
+        self.calls = {}
+        self.stacks = {}
+
+
+    def trace(self, length, pc):
+        stack = self.stack
+        function = stack[-1]
+        self.cycles += length
+        self.exclusive[function] = self.exclusive.get(function, 0) + length
+        self.stacks[stack] = self.stacks.get(stack, 0) + length
+
+        if pc in self.entries:
+            function = self.entries[pc]
+            self.stack = stack + (function,)
+            self.entryCycles.append(self.cycles)
+            self.calls[function] = self.calls.get(function, 0) + 1
+        elif pc in self.returns and len(stack) > 1:
+            # a tail call enters the callee without leaving the function it came from,
+            # so one return can end several functions, up to the caller
+            self.leave()
+            caller = self.returns[pc]
+            if caller in self.stack:
+                while self.stack[-1] != caller:
+                    self.leave()
+
+
+    def leave(self):
+        function = self.stack[-1]
+        self.stack = self.stack[:-1]
+        entry = self.entryCycles.pop()
+        # time of recursive calls is already part of the outermost call
+        if function not in self.stack:
+            self.inclusive[function] = self.inclusive.get(function, 0) + self.cycles - entry
+
+
+    def run(self, max_cycles=None):
+        before = self.cycles
+        n = self.emulator.run_blocks(max_cycles, self.trace)
+        # whatever ran after the last block (an interpreted tail) belongs to the current function
+        if n > self.cycles - before:
+            self.trace(n - (self.cycles - before), None)
+        return n
+
+
+    def finish(self):
+        # functions still active when the program stopped
+        while len(self.stack) > 1:
+            self.leave()
+        self.inclusive["<bootstrap>"] = self.cycles
+
+
+    def report(self, top=None):
+        total = self.cycles or 1
+        rows = sorted(self.exclusive.items(), key=lambda item: item[1], reverse=True)[:top]
+        lines = [f"{'function':<40} {'exclusive':>12} {'%':>6} {'inclusive':>12} {'%':>6} {'calls':>8}"]
+        for function, exclusive in rows:
+            inclusive = self.inclusive.get(function, exclusive)
+            lines.append(f"{function:<40} {exclusive:>12} {100 * exclusive / total:>6.2f} "
+                         f"{inclusive:>12} {100 * inclusive / total:>6.2f} {self.calls.get(function, 0):>8}")
+        return "\n".join(lines)
+
+
+    def collapsed_stacks(self):
+        # one "outer;inner count" line per call stack, the input format of flamegraph.pl
+        for stack, cycles in sorted(self.stacks.items()):
+            yield ";".join(stack) + f" {cycles}\n"
+
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    flags = dict(arg[2:].split("=", 1) if "=" in arg else (arg[2:], "") for arg in sys.argv[1:] if arg.startswith("--"))
+
+    if args[0].endswith(".asm"):
+        # the labels only exist in the assembly, so the profiler assembles the program itself
+        with open(args[0], "r") as file:
+            parser = MyAssembler.Parser()
+            rom = array.array('H', parser(file))
+        labels = parser.labels
+    else:
+        # an assembled program needs the source map written by MyAssembler.py --map
+        rom = HackEmulator.load_program(args[0])
+        labels = MyAssembler.SourceMap(flags.get("map") or os.path.splitext(args[0])[0] + ".map").labels()
+
+    emulator = HackEmulator.Emulator(rom, compiled=True)
+    profiler = Profiler(emulator, labels)
+    maxCycles = int(flags["cycles"]) if "cycles" in flags else None
+
+    start = time.perf_counter()
+    profiler.run(maxCycles)
+    profiler.finish()
+    elapsed = time.perf_counter() - start
+
+    print(f"{os.path.basename(args[0])}: {profiler.cycles} cycles in {elapsed:.2f}s")
+    print(profiler.report(int(flags["top"]) if "top" in flags else None))
+
+    if "collapsed" in flags:
+        with open(flags["collapsed"], "w+") as output:
+            output.writelines(profiler.collapsed_stacks())
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -1,7 +1,95 @@
 import sys
+import os
+import itertools
+import array
+import mmap
+import time
+import struct
+import bisect
+import concurrent.futures
+
+
+# comp bits including the a-bit, i.e. the 7 bits a c1..c6 of a C-instruction
+compTable = {
+    "0":    0b0101010,
+    "1":    0b0111111,
+    "-1":   0b0111010,
+    "D":    0b0001100,
+    "A":    0b0110000,
+    "M":    0b1110000,
+    "!D":   0b0001101,
+    "!A":   0b0110001,
+    "!M":   0b1110001,
+    "-D":   0b0001111,
+    "-A":   0b0110011,
+    "-M":   0b1110011,
+    "D+1":  0b0011111,
+    "A+1":  0b0110111,
+    "M+1":  0b1110111,
+    "D-1":  0b0001110,
+    "A-1":  0b0110010,
+    "M-1":  0b1110010,
+    "D+A":  0b0000010,
+    "D+M":  0b1000010,
+    "D-A":  0b0010011,
+    "D-M":  0b1010011,
+    "A-D":  0b0000111,
+    "M-D":  0b1000111,
+    "D&A":  0b0000000,
+    "D&M":  0b1000000,
+    "D|A":  0b0010101,
+    "D|M":  0b1010101
+}
+# the commutative operations may also be written the other way around, e.g. M+D
+for comp, bits in list(compTable.items()):
+    if len(comp) == 3 and comp[1] in "+&|":
+        compTable[comp[2] + comp[1] + comp[0]] = bits
+
+jumpTable = {
+    "": 0b000,
+    "JGT": 0b001,
+    "JEQ": 0b010,
+    "JGE": 0b011,
+    "JLT": 0b100,
+    "JNE": 0b101,
+    "JLE": 0b110,
+    "JMP": 0b111
+}
+
+destTable = {"": 0b000}
+for dest, bits in {"M": 0b001, "D": 0b010, "MD": 0b011, "A": 0b100, "AM": 0b101, "AD": 0b110, "AMD": 0b111}.items():
+    # the order of the destination registers doesn't matter, so DM is the same as MD
+    for permutation in itertools.permutations(dest):
+        destTable["".join(permutation)] = bits
+
+# every possible C-instruction mapped to its machine word
+cInstructionTable = {}
+for dest, destBits in destTable.items():
+    for comp, compBits in compTable.items():
+        for jump, jumpBits in jumpTable.items():
+            inst = (dest + "=" if dest else "") + comp + (";" + jump if jump else "")
+            cInstructionTable[inst] = 0b111 << 13 | compBits << 6 | destBits << 3 | jumpBits
+
+
+def split_cinstruction(inst):
+    dest = ""
+    jump = ""
+    if '=' in inst:
+        [dest, inst] = inst.split('=')
+
+    if ';' in inst:
+        [inst, jump] = inst.split(';')
+
+    return dest, inst, jump
+
 
 class Parser:
-    def __init__(self):
+    def __init__(self, optimize=False):
+        self.optimize = optimize
+        self.labels = {}
+        self.variables = {}
+        self.sourceLines = []   # line number in the .asm file of every purified instruction
+        self.romLines = []      # line number in the .asm file of every ROM address
         self.symbolTable = {
             "SCREEN": 16384,
             "KBD": 24576,
@@ -14,60 +102,11 @@ class Parser:
         for i in range(0, 16):
             self.symbolTable["R" + str(i)] = i
 
-        self.compTable = {
-            "0":    "0101010",
-            "1":    "0111111",
-            "-1":   "0111010",
-            "D":    "0001100",
-            "A":    "0110000",
-            "M":    "1110000",  
-            "!D":   "0001101",
-            "!A":   "0110001",  
-            "!M":   "1110001",
-            "-D":   "0001111",
-            "-A":   "0110011",
-            "-M":   "1110011",
-            "D+1":  "0011111",
-            "A+1":  "0110111",
-            "M+1":  "1110111",
-            "D-1":  "0001110",
-            "A-1":  "0110010",
-            "M-1":  "1110010",
-            "D+A":  "0000010",
-            "D+M":  "1000010",
-            "D-A":  "0010011",
-            "D-M":  "1010011",
-            "A-D":  "0000111",
-            "M-D":  "1000111",
-            "D&A":  "0000000",
-            "D&M":  "1000000",
-            "D|A":  "0010101",
-            "D|M":  "1010101"
-        }
-        self.jumpTable = {
-            "": "000",
-            "JGT": "001",
-            "JEQ": "010",
-            "JGE": "011",
-            "JLT": "100",
-            "JNE": "101",
-            "JLE": "110",
-            "JMP": "111"
-        }
-        self.destTable = {
-            "": "000",
-            "M": "001",
-            "D": "010",
-            "MD": "011",
-            "A": "100",
-            "AM": "101",
-            "AD": "110",
-            "AMD": "111"
-        }
-        
 
     def __call__(self, file):
         instructions = self.purify(file)
+        if self.optimize:
+            instructions = self.peephole(instructions)
         self.add_labels_to_symboltable(instructions)
         instructionsL = self.replace_symbols(instructions)
         return self.parse(instructionsL)
@@ -75,24 +114,109 @@ class Parser:
 
     def purify(self, file):
         instructions = []
-        for line in file:
+        for lineNumber, line in enumerate(file, 1):
             removedComments = line.split("//")[0]
             removedWhitespace = removedComments.strip()
             if removedWhitespace != "":
                 instructions.append(removedWhitespace)
+                self.sourceLines.append(lineNumber)
 
         return instructions
 
 
-    def add_labels_to_symboltable(self, instructions):
+    def peephole(self, instructions):
+        # removing instructions can expose new patterns, so repeat until nothing changes;
+        # labels are still in the list, so their addresses are recomputed by the first pass
+        while True:
+            keep = self.peephole_pass(instructions)
+            if all(keep):
+                return instructions
+            instructions = [inst for inst, k in zip(instructions, keep) if k]
+            self.sourceLines = [line for line, k in zip(self.sourceLines, keep) if k]
+
+
+    def peephole_pass(self, instructions):
+        keep = [True] * len(instructions)
+        knownA = None   # symbol A is known to hold, forgotten at labels and writes to A
         i = 0
         while i < len(instructions):
-            if instructions[i][0] == '(':
-                line = instructions.pop(i)
-                label = line[1:-1]
-                self.symbolTable[label] = i
+            inst = instructions[i]
+
+            if inst[0] == '(':
+                knownA = None
+            elif inst[0] == '@':
+                # @SP M=M+1 @SP M=M-1 leaves SP as it was and A pointing at SP
+                if inst == "@SP" and instructions[i + 1:i + 4] == ["M=M+1", "@SP", "M=M-1"]:
+                    keep[i + 1] = keep[i + 2] = keep[i + 3] = False
+                    knownA = "SP"
+                    i += 4
+                    continue
+
+                # a jump without side effects to the very next instruction, as long as
+                # the code after the label doesn't use the address left in A
+                if i + 1 < len(instructions) and instructions[i + 1][0] not in "@(":
+                    dest, comp, jump = split_cinstruction(instructions[i + 1])
+                    if jump and not dest and self.is_label_ahead(instructions, i + 2, inst[1:]) and self.is_dead_a(instructions, i + 2):
+                        keep[i] = keep[i + 1] = False
+                        i += 2
+                        continue
+
+                if inst[1:] == knownA:
+                    keep[i] = False
+                knownA = inst[1:]
             else:
-                i += 1
+                dest, comp, jump = split_cinstruction(inst)
+                if dest == "D" and not jump and self.is_dead_d(instructions, i + 1):
+                    keep[i] = False
+                if 'A' in dest:
+                    knownA = None
+            i += 1
+
+        return keep
+
+
+    def is_label_ahead(self, instructions, i, label):
+        while i < len(instructions) and instructions[i][0] == '(':
+            if instructions[i][1:-1] == label:
+                return True
+            i += 1
+        return False
+
+
+    def is_dead_a(self, instructions, i):
+        # A is dead if the first instruction after the labels at i overwrites it
+        while i < len(instructions) and instructions[i][0] == '(':
+            i += 1
+        return i < len(instructions) and instructions[i][0] == '@'
+
+
+    def is_dead_d(self, instructions, i, window=8):
+        # D is dead if it is overwritten before anything can read it; labels and
+        # jumps end the search because code elsewhere might still need D
+        for inst in instructions[i:i + window]:
+            if inst[0] == '(':
+                return False
+            if inst[0] == '@':
+                continue
+            dest, comp, jump = split_cinstruction(inst)
+            if 'D' in comp or jump:
+                return False
+            if 'D' in dest:
+                return True
+        return False
+
+
+    def add_labels_to_symboltable(self, instructions):
+        # first pass: a label refers to the address of the next instruction,
+        # so only the non-label lines advance the address counter
+        address = 0
+        for instruction, line in zip(instructions, self.sourceLines):
+            if instruction[0] == '(':
+                self.symbolTable[instruction[1:-1]] = address
+                self.labels[instruction[1:-1]] = address
+            else:
+                self.romLines.append(line)
+                address += 1
 
 
     def replace_symbols(self, instructions):
@@ -111,57 +235,269 @@ class Parser:
                     symbolvalue = self.symbolTable.get(symbolCandidate)
                     if symbolvalue == None:
                         self.symbolTable[symbolCandidate] = symbolvalue = regPointer
+                        self.variables[symbolCandidate] = regPointer
                         regPointer += 1
                     return "@" + str(symbolvalue)      
 
-        return map(f, instructions)
+        # second pass: labels were resolved by the first pass and are skipped here
+        return map(f, (instruction for instruction in instructions if instruction[0] != '('))
 
 
     def ainstruction(self, inst):
         num = int(inst[1:])
-        bin = int_to_binstring(num)
-        return bin.rjust(16, '0')
+        if num > 0x7FFF:
+            raise Exception("A-instruction out of range: " + inst)
+        return num
 
 
     def cinstruction(self, inst):
-        dest = ""
-        jump = ""
-        if '=' in inst:
-            [dest, inst] = inst.split('=')
+        word = cInstructionTable.get(inst)
+        if word == None:
+            raise Exception("Invalid C-instruction: " + inst)
+        return word
 
-        if ';' in inst:
-            [inst, jump] = inst.split(';')
 
-        comp = inst
+    def parse(self, instructions):
+        for inst in instructions:
+            yield self.ainstruction(inst) if inst[0] == '@' else self.cinstruction(inst)
 
-        return "111" + self.compTable[comp] + self.destTable[dest] + self.jumpTable[jump]
 
 
-    def parse(self, instructions):
-        binary = ""
-        for i, inst in enumerate(instructions):
-            binary += self.ainstruction(inst) if inst[0] == '@' else self.cinstruction(inst)
-            binary += '\n'
+def hack_lines(words):
+    for word in words:
+        yield format(word, "016b") + "\n"
 
-        return binary
 
+def write_rom(words, file):
+    # packed little-endian 16-bit words, the file is a raw image of the ROM
+    rom = array.array('H', words)
+    if sys.byteorder == 'big':
+        rom.byteswap()
+    rom.tofile(file)
 
 
-def int_to_binstring(num):
-    return int_to_binstring(num >> 1) + str(num % 2) if num > 1 else str(num)
+def load_rom(filePath):
+    with open(filePath, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if size % 2 != 0:
+            raise Exception("Not a ROM image, odd number of bytes: " + filePath)
+        if size == 0:
+            return array.array('H')
 
+        if sys.byteorder == 'little':
+            # the mapping stays alive as long as the view does, so nothing is copied
+            return memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)).cast('H')
+
+        rom = array.array('H')
+        rom.fromfile(file, size // 2)
+        rom.byteswap()
+        return rom
+
+
+def load_hack(filePath):
+    with open(filePath, "r") as file:
+        return array.array('H', (int(line, 2) for line in file if line.strip()))
+
+
+# Source map: a header, then the .asm line of every ROM address, the labels sorted by ROM
+# address and the variables sorted by RAM address, each name an offset into a string block.
+sourceMapHeader = struct.Struct("<4sHHIIII")
+SOURCE_MAP_MAGIC = b"HMAP"
+# version 2 stores label and variable addresses as 32 bits, programs can be longer than 64K words
+SOURCE_MAP_VERSION = 2
+
+
+def write_source_map(parser, sourceName, file):
+    strings = bytearray()
+
+    def string(name):
+        offset = len(strings)
+        strings.extend(name.encode() + b"\0")
+        return offset
+
+    source = string(sourceName)
+    labels = sorted((address, name) for name, address in parser.labels.items())
+    variables = sorted((address, name) for name, address in parser.variables.items())
+
+    sections = [
+        array.array('I', parser.romLines),
+        array.array('I', [address for address, name in labels]),
+        array.array('I', [string(name) for address, name in labels]),
+        array.array('I', [address for address, name in variables]),
+        array.array('I', [string(name) for address, name in variables])
+    ]
+    # the map is built completely before anything is written, a failure leaves no partial file
+    data = bytearray(sourceMapHeader.pack(SOURCE_MAP_MAGIC, SOURCE_MAP_VERSION, 0, len(parser.romLines), len(labels), len(variables), source))
+    for section in sections:
+        if sys.byteorder == 'big':
+            section.byteswap()
+        data += section.tobytes()
+    data += strings
+    file.write(data)
+
+
+def source_map_size(header):
+    # the size of a source map without its string block, from its header
+    magic, version, _, romSize, numLabels, numVariables, source = sourceMapHeader.unpack_from(header)
+    if magic != SOURCE_MAP_MAGIC or version != SOURCE_MAP_VERSION:
+        return None
+    return sourceMapHeader.size + 4 * (romSize + 2 * numLabels + 2 * numVariables)
 
-def main():
-    filePath = sys.argv[1]
-    if not filePath:
-        filePath = input("Please enter the path to the file you want to assemble")
 
+def is_valid_source_map(filePath):
+    with open(filePath, "rb") as file:
+        header = file.read(sourceMapHeader.size)
+    if len(header) < sourceMapHeader.size:
+        return False
+    size = source_map_size(header)
+    # the string block holds at least the name of the source
+    return size != None and os.path.getsize(filePath) > size
+
+
+
+class SourceMap:
+    def __init__(self, filePath):
+        with open(filePath, "rb") as file:
+            data = file.read()
+
+        if len(data) < sourceMapHeader.size or source_map_size(data) == None:
+            raise Exception("Not a source map: " + filePath)
+        magic, version, _, romSize, numLabels, numVariables, source = sourceMapHeader.unpack_from(data)
+
+        offset = sourceMapHeader.size
+        sections = []
+        for typecode, length in [('I', romSize), ('I', numLabels), ('I', numLabels), ('I', numVariables), ('I', numVariables)]:
+            section = array.array(typecode)
+            section.frombytes(data[offset:offset + length * section.itemsize])
+            if sys.byteorder == 'big':
+                section.byteswap()
+            sections.append(section)
+            offset += length * section.itemsize
+
+        self.romLines, self.labelAddresses, labelNames, self.variableAddresses, variableNames = sections
+        self.strings = data[offset:]
+        self.source = self.string(source)
+        self.labelNames = [self.string(name) for name in labelNames]
+        self.variableNames = [self.string(name) for name in variableNames]
+
+
+    def string(self, offset):
+        return self.strings[offset:self.strings.index(b"\0", offset)].decode()
+
+
+    def line_of(self, address):
+        return self.romLines[address]
+
+
+    def label_of(self, address):
+        # the closest label at or before address and how far address is past it
+        i = bisect.bisect_right(self.labelAddresses, address) - 1
+        if i < 0:
+            return None, address
+        return self.labelNames[i], address - self.labelAddresses[i]
+
+
+    def variable_at(self, address):
+        i = bisect.bisect_left(self.variableAddresses, address)
+        if i < len(self.variableAddresses) and self.variableAddresses[i] == address:
+            return self.variableNames[i]
+        return None
+
+
+    def labels(self):
+        return dict(zip(self.labelNames, self.labelAddresses))
+
+
+    def variables(self):
+        return dict(zip(self.variableNames, self.variableAddresses))
+
+
+
+def output_path(filePath, rom=False):
+    return os.path.splitext(filePath)[0] + (".rom" if rom else ".hack")
+
+
+def map_path(filePath):
+    return os.path.splitext(filePath)[0] + ".map"
+
+
+def assemble_file(filePath, rom=False, optimize=False, sourceMap=False):
+    # every file gets its own parser, so variables of one program never leak into the next
     with open(filePath, "r") as file:
-        parser = Parser()
-        hack_binary = parser(file)
+        parser = Parser(optimize)
+        words = array.array('H', parser(file))
+
+    if sourceMap:
+        # an interrupted write must not leave a map behind that looks current
+        with open(map_path(filePath) + ".tmp", "wb") as output:
+            write_source_map(parser, os.path.basename(filePath), output)
+        os.replace(map_path(filePath) + ".tmp", map_path(filePath))
+
+    if rom:
+        with open(output_path(filePath, rom), "wb") as output:
+            write_rom(words, output)
+    else:
+        with open(output_path(filePath, rom), "w+") as output:
+            output.writelines(hack_lines(words))
+
+    return len(words)
+
+
+def find_asm_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files += [os.path.join(root, name) for name in sorted(names) if name.endswith(".asm")]
+        else:
+            files.append(path)
+    return files
+
+
+def is_up_to_date(filePath, rom=False, sourceMap=False):
+    # with sourceMap the .map sidecar has to be current as well
+    outputs = [output_path(filePath, rom)] + ([map_path(filePath)] if sourceMap else [])
+    if not all(os.path.exists(output) and os.path.getmtime(output) >= os.path.getmtime(filePath) for output in outputs):
+        return False
+    return not sourceMap or is_valid_source_map(map_path(filePath))
+
+
+def assemble_batch(paths, rom=False, workers=None, force=False, optimize=False, sourceMap=False):
+    files = find_asm_files(paths)
+    outdated = [file for file in files if force or not is_up_to_date(file, rom, sourceMap)]
+
+    start = time.perf_counter()
+    numWords = 0
+    if outdated:
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            numWords = sum(pool.map(assemble_file, outdated, itertools.repeat(rom), itertools.repeat(optimize), itertools.repeat(sourceMap)))
+    elapsed = time.perf_counter() - start
+
+    print(f"assembled {len(outdated)} of {len(files)} files ({len(files) - len(outdated)} up to date) "
+          f"in {elapsed:.2f}s: {len(outdated) / elapsed if elapsed else 0:.1f} files/s, "
+          f"{numWords / elapsed if elapsed else 0:.0f} words/s")
+    return numWords
+
 
-    with open(filePath.replace('.asm', '.hack'), "w+") as file:
-        file.write(hack_binary)
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    flags = [arg for arg in sys.argv[1:] if arg.startswith("--")]
+    rom = "--rom" in flags
+    optimize = "--optimize" in flags
+    sourceMap = "--map" in flags
+
+    # a directory or several files are assembled as a batch on all cores
+    if len(args) > 1 or (args and os.path.isdir(args[0])):
+        workers = None
+        for flag in flags:
+            if flag.startswith("--jobs="):
+                workers = int(flag[len("--jobs="):])
+        assemble_batch(args, rom, workers, "--force" in flags, optimize, sourceMap)
+        return
+
+    filePath = args[0] if args else input("Please enter the path to the file you want to assemble")
+    assemble_file(filePath, rom, optimize, sourceMap)
 
 
 if __name__ == "__main__":
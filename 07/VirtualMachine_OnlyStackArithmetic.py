@@ -69,14 +69,36 @@ class Parser:
 
 
 
+# number of instructions the CodeWriter holds before writing them out
+BATCH_SIZE = 1 << 12
+
+
 class CodeWriter:
     def __init__(self, outputFile):
+        # stripped instructions are written to the outputFile in batches
+        self.outputFile = outputFile
         self.output = open(outputFile, "w+")
+        self.instructions = []
         self.currentClass = None
         self.counter = 0
 
 
+    def emit(self, translation):
+        # hack instructions never contain whitespace, so splitting the templates on it
+        # drops their indentation and blank lines and leaves one instruction per item
+        self.instructions.extend(translation.split())
+        if len(self.instructions) >= BATCH_SIZE:
+            self.flush()
+
+
+    def flush(self):
+        if self.instructions:
+            self.output.writelines(("\n".join(self.instructions), "\n"))
+            self.instructions.clear()
+
+
     def close(self):
+        self.flush()
         self.output.close()
 
 
@@ -147,7 +169,7 @@ class CodeWriter:
             @SP
             M=M+1
         """
-        self.output.write(translation)
+        self.emit(translation)
 
 
     def writePushPop(self, command, segment, index):
@@ -222,7 +244,7 @@ class CodeWriter:
                 M=D
             """
 
-        self.output.write(translation)
+        self.emit(translation)
 
 
     def writeLabel(self, label):
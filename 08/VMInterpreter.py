@@ -0,0 +1,370 @@
+import sys
+import os
+import time
+
+import VirtualMachine
+from VirtualMachine import C_ARITHMETIC, C_PUSH, C_POP, C_LABEL, C_GOTO, C_IF, C_RETURN, C_CALL
+
+
+RAM_SIZE = 0x8000
+STACK = 256
+HEAP = 2048
+SCREEN = 16384
+
+
+# opcodes of the predecoded program, the pushes and pops first since they are the most common
+(PUSH_CONSTANT, PUSH_LOCAL, PUSH_ARGUMENT, PUSH_THIS, PUSH_THAT, PUSH_RAM, PUSH_POINTER,
+ POP_LOCAL, POP_ARGUMENT, POP_THIS, POP_THAT, POP_RAM, POP_POINTER,
+ ADD, SUB, NEG, EQ, GT, LT, AND, OR, NOT,
+ GOTO, IF_GOTO, FUNCTION, CALL, NATIVE, RETURN, HALT) = range(29)
+
+pushOpcodes = {"constant": PUSH_CONSTANT, "local": PUSH_LOCAL, "argument": PUSH_ARGUMENT, "this": PUSH_THIS,
+               "that": PUSH_THAT, "static": PUSH_RAM, "temp": PUSH_RAM, "pointer": PUSH_POINTER}
+popOpcodes = {"local": POP_LOCAL, "argument": POP_ARGUMENT, "this": POP_THIS, "that": POP_THAT,
+              "static": POP_RAM, "temp": POP_RAM, "pointer": POP_POINTER}
+arithmeticOpcodes = {"add": ADD, "sub": SUB, "neg": NEG, "eq": EQ, "gt": GT, "lt": LT, "and": AND, "or": OR, "not": NOT}
+
+
+def signed(word):
+    return word - 0x10000 if word & 0x8000 else word
+
+
+
+#====================== Builtins ==========================
+# Python versions of OS functions, they get the interpreter and the arguments as 16-bit words
+# and return the result, which is truncated to 16 bits
+def mathMultiply(vm, x, y):
+    return signed(x) * signed(y)
+
+
+def mathDivide(vm, x, y):
+    if y == 0:
+        raise Exception("Math.divide: division by zero")
+    # Jack rounds towards zero
+    quotient = abs(signed(x)) // abs(signed(y))
+    return quotient if (x & 0x8000) == (y & 0x8000) else -quotient
+
+
+def mathSqrt(vm, x):
+    if x & 0x8000:
+        raise Exception("Math.sqrt: negative argument")
+    root = 0
+    while (root + 1) * (root + 1) <= x:
+        root += 1
+    return root
+
+
+def memoryAlloc(vm, size):
+    # first fit from a free list, the size of a block is kept in the word before it like the OS does
+    size = max(size, 1)
+    for i, (address, blockSize) in enumerate(vm.freeBlocks):
+        if blockSize >= size + 1:
+            if blockSize - size - 1 > 1:
+                vm.freeBlocks[i] = (address + size + 1, blockSize - size - 1)
+            else:
+                del vm.freeBlocks[i]
+                size = blockSize - 1
+            vm.ram[address] = size
+            return address + 1
+    raise Exception(f"Memory.alloc: no block of {size} words left")
+
+
+def memoryDeAlloc(vm, address):
+    # freed blocks are tried first, as in the OS
+    vm.freeBlocks.insert(0, (address - 1, vm.ram[address - 1] + 1))
+    return 0
+
+
+def memoryPoke(vm, address, value):
+    # addresses wrap like they do on Hack
+    vm.ram[address & 0x7FFF] = value
+    return 0
+
+
+def sysHalt(vm):
+    vm.halted = True
+    return 0
+
+
+def sysError(vm, code):
+    raise Exception(f"Sys.error: {signed(code)}")
+
+
+builtins = {
+    "Math.multiply":    mathMultiply,
+    "Math.divide":      mathDivide,
+    "Math.sqrt":        mathSqrt,
+    "Math.abs":         lambda vm, x: abs(signed(x)),
+    "Math.min":         lambda vm, x, y: min(signed(x), signed(y)),
+    "Math.max":         lambda vm, x, y: max(signed(x), signed(y)),
+    "Memory.peek":      lambda vm, address: vm.ram[address & 0x7FFF],
+    "Memory.poke":      memoryPoke,
+    "Memory.alloc":     memoryAlloc,
+    "Memory.deAlloc":   memoryDeAlloc,
+    "Sys.halt":         sysHalt,
+    "Sys.error":        sysError,
+    "Sys.wait":         lambda vm, duration: 0
+}
+
+
+
+class VMInterpreter:
+    def __init__(self, files, natives=()):
+        # natives are names of builtins that replace the VM functions of the same name,
+        # builtins are also used for functions the program doesn't define
+        self.ram = [0] * RAM_SIZE
+        self.freeBlocks = [(HEAP, SCREEN - HEAP)]
+        self.load([function for file in files for function in VirtualMachine.readFile(file)], natives)
+        self.reset()
+
+
+    def load(self, functions, natives):
+        # labels and functions are resolved to indexes into the code, statics and temps to RAM addresses
+        self.code = []
+        self.functions = {}
+        self.statics = {}
+        labels = {}
+        jumps = []
+
+        for function in functions:
+            if function.name != None:
+                self.functions[function.name] = len(self.code)
+                self.code.append((FUNCTION, function.nVars))
+            for command in function.commands():
+                if command.type == C_LABEL:
+                    labels[(function.name, command.arg1)] = len(self.code)
+                    continue
+                if command.type in [C_GOTO, C_IF]:
+                    jumps.append((len(self.code), function.name, command.arg1))
+                self.code.append(self.decode(command, function.className))
+
+        for index, functionName, label in jumps:
+            if (functionName, label) not in labels:
+                raise Exception(f"unknown label {label} in {functionName}")
+            opcode, target = self.code[index][0], labels[(functionName, label)]
+            # a goto to itself never does anything again
+            self.code[index] = (HALT, None) if opcode == GOTO and target == index else (opcode, target)
+
+        calledNatives = set()
+        for index, (opcode, argument) in enumerate(self.code):
+            if opcode == CALL:
+                functionName, nArgs = argument
+                if functionName in natives or functionName not in self.functions:
+                    if functionName not in builtins:
+                        raise Exception(f"unknown function {functionName}")
+                    self.code[index] = (NATIVE, (builtins[functionName], nArgs))
+                    calledNatives.add(functionName)
+                else:
+                    self.code[index] = (CALL, (self.functions[functionName], nArgs))
+
+        # the builtins keep their own free list, blocks can't go from one heap to the other
+        memory = ["Memory.alloc", "Memory.deAlloc"]
+        vmMemory = [name for name in memory if name in self.functions and name not in natives]
+        if len(vmMemory) == 1 and calledNatives.intersection(memory):
+            raise Exception("Memory.alloc and Memory.deAlloc can only be native together")
+
+
+    def decode(self, command, className):
+        if command.type == C_ARITHMETIC:
+            return (arithmeticOpcodes[command.arg1], None)
+        if command.type in [C_PUSH, C_POP]:
+            segment, index = command.arg1, command.arg2
+            opcode = (pushOpcodes if command.type == C_PUSH else popOpcodes)[segment]
+            if segment == "static":
+                # statics get addresses from 16 on in the order they appear, as the assembler does it
+                index = self.statics.setdefault((className, index), 16 + len(self.statics))
+            elif segment == "temp":
+                index += 5
+            elif segment == "pointer":
+                index += 3
+            return (opcode, index)
+        if command.type in [C_GOTO, C_IF]:
+            return (GOTO if command.type == C_GOTO else IF_GOTO, None)
+        if command.type == C_CALL:
+            return (CALL, (command.arg1, command.arg2))
+        if command.type == C_RETURN:
+            return (RETURN, None)
+        raise Exception(f"can't interpret {command}")
+
+
+    def reset(self):
+        # like the bootstrap, Sys.init is called with an empty stack, a return from it ends the program
+        ram = self.ram
+        self.steps = 0
+        self.halted = False
+        if "Sys.init" in self.functions:
+            ram[0:5] = [STACK + 5, STACK + 5, STACK, 0, 0]
+            ram[STACK] = -1
+            self.pc = self.functions["Sys.init"]
+        else:
+            if ram[0] == 0:
+                ram[0] = STACK
+            self.pc = 0
+
+
+    def run(self, max_steps=None):
+        code = self.code
+        ram = self.ram
+        size = len(code)
+        pc = self.pc
+        # the pointers live in locals while running and are written back to RAM[0-4] afterwards
+        sp, lcl, arg, this, that = ram[0:5]
+        remaining = max_steps if max_steps != None else float("inf")
+
+        n = 0
+        while n < remaining and pc < size:
+            opcode, x = code[pc]
+            pc += 1
+            n += 1
+
+            if opcode == PUSH_CONSTANT:
+                ram[sp] = x
+                sp += 1
+            elif opcode == PUSH_LOCAL:
+                ram[sp] = ram[lcl + x]
+                sp += 1
+            elif opcode == PUSH_ARGUMENT:
+                ram[sp] = ram[arg + x]
+                sp += 1
+            elif opcode == PUSH_RAM:
+                ram[sp] = ram[x]
+                sp += 1
+            elif opcode == PUSH_THIS:
+                ram[sp] = ram[(this + x) & 0x7FFF]
+                sp += 1
+            elif opcode == PUSH_THAT:
+                ram[sp] = ram[(that + x) & 0x7FFF]
+                sp += 1
+            elif opcode == PUSH_POINTER:
+                ram[sp] = this if x == 3 else that
+                sp += 1
+            elif opcode == POP_LOCAL:
+                sp -= 1
+                ram[lcl + x] = ram[sp]
+            elif opcode == POP_ARGUMENT:
+                sp -= 1
+                ram[arg + x] = ram[sp]
+            elif opcode == POP_RAM:
+                sp -= 1
+                ram[x] = ram[sp]
+            elif opcode == POP_THIS:
+                sp -= 1
+                ram[(this + x) & 0x7FFF] = ram[sp]
+            elif opcode == POP_THAT:
+                sp -= 1
+                ram[(that + x) & 0x7FFF] = ram[sp]
+            elif opcode == POP_POINTER:
+                sp -= 1
+                if x == 3:
+                    this = ram[sp]
+                else:
+                    that = ram[sp]
+            elif opcode == ADD:
+                sp -= 1
+                ram[sp - 1] = (ram[sp - 1] + ram[sp]) & 0xFFFF
+            elif opcode == SUB:
+                sp -= 1
+                ram[sp - 1] = (ram[sp - 1] - ram[sp]) & 0xFFFF
+            elif opcode == NEG:
+                ram[sp - 1] = -ram[sp - 1] & 0xFFFF
+            elif opcode == NOT:
+                ram[sp - 1] = ram[sp - 1] ^ 0xFFFF
+            elif opcode == AND:
+                sp -= 1
+                ram[sp - 1] &= ram[sp]
+            elif opcode == OR:
+                sp -= 1
+                ram[sp - 1] |= ram[sp]
+            elif opcode == EQ:
+                sp -= 1
+                ram[sp - 1] = 0xFFFF if ram[sp - 1] == ram[sp] else 0
+            elif opcode == GT:
+                # the same x - y as on Hack, overflow included
+                sp -= 1
+                ram[sp - 1] = 0xFFFF if 0 < (ram[sp - 1] - ram[sp]) & 0xFFFF < 0x8000 else 0
+            elif opcode == LT:
+                sp -= 1
+                ram[sp - 1] = 0xFFFF if (ram[sp - 1] - ram[sp]) & 0xFFFF >= 0x8000 else 0
+            elif opcode == GOTO:
+                pc = x
+            elif opcode == IF_GOTO:
+                sp -= 1
+                if ram[sp]:
+                    pc = x
+            elif opcode == FUNCTION:
+                for i in range(x):
+                    ram[sp + i] = 0
+                sp += x
+            elif opcode == CALL:
+                target, nArgs = x
+                ram[sp:sp + 5] = [pc, lcl, arg, this, that]
+                arg = sp - nArgs
+                sp += 5
+                lcl = sp
+                pc = target
+            elif opcode == RETURN:
+                frame = lcl
+                pc = ram[frame - 5]
+                ram[arg] = ram[sp - 1]
+                sp = arg + 1
+                lcl, arg, this, that = ram[frame - 4:frame]
+                if pc == -1:
+                    self.halted = True
+                    break
+            elif opcode == NATIVE:
+                function, nArgs = x
+                # builtins see the same RAM as the VM code
+                ram[0:5] = [sp, lcl, arg, this, that]
+                sp -= nArgs
+                ram[sp] = function(self, *ram[sp:sp + nArgs]) & 0xFFFF
+                sp += 1
+                if self.halted:
+                    break
+            elif opcode == HALT:
+                pc -= 1
+                self.halted = True
+                break
+
+        ram[0:5] = [sp, lcl, arg, this, that]
+        self.pc = pc
+        self.steps += n
+        return n
+
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    flags = dict(arg[2:].split("=", 1) if "=" in arg else (arg[2:], "") for arg in sys.argv[1:] if arg.startswith("--"))
+    input = args[0]
+
+    if os.path.isdir(input):
+        files = sorted(os.path.join(input, file) for file in os.listdir(input) if file.endswith(".vm"))
+    else:
+        files = [input]
+
+    # --native runs all builtins in Python, --native=Math.multiply,Memory.alloc only those
+    natives = ()
+    if "native" in flags:
+        natives = flags["native"].split(",") if flags["native"] else builtins.keys()
+
+    interpreter = VMInterpreter(files, natives)
+    maxSteps = int(flags["steps"]) if "steps" in flags else None
+
+    start = time.perf_counter()
+    steps = interpreter.run(maxSteps)
+    elapsed = time.perf_counter() - start
+
+    status = "halted" if interpreter.halted else ("stopped" if interpreter.pc < len(interpreter.code) else "ran off the end")
+    print(f"{os.path.basename(input)}: {status} after {steps} commands in {elapsed:.2f}s "
+          f"({steps / elapsed / 1e6 if elapsed else 0:.2f}M commands/s)")
+
+    # --ram=0-15,256 prints those RAM words
+    for part in flags.get("ram", "").split(","):
+        if part:
+            first, _, last = part.partition("-")
+            for address in range(int(first), int(last or first) + 1):
+                print(f"RAM[{address}] = {signed(interpreter.ram[address])}")
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
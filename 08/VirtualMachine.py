@@ -1,5 +1,10 @@
 import sys
 import os
+import io
+import glob
+import hashlib
+import itertools
+import concurrent.futures
 
 
 C_ARITHMETIC    = "C_ARITHMETIC"
@@ -11,6 +16,8 @@ C_IF            = "C_IF"
 C_FUNCTION      = "C_FUNCTION"
 C_RETURN        = "C_RETURN"
 C_CALL          = "C_CALL"
+# only produced by the tail call pass, a call that reuses the frame of the returning function
+C_TAILCALL      = "C_TAILCALL"
 
 
 class Parser:
@@ -72,6 +79,386 @@ class Parser:
 
 
 
+class Command:
+    __slots__ = ("type", "arg1", "arg2")
+
+    def __init__(self, type, arg1=None, arg2=None):
+        # arithmetic commands keep their name in arg1, indexes and counts are ints
+        self.type = type
+        self.arg1 = arg1
+        self.arg2 = arg2
+
+
+    def __eq__(self, other):
+        return isinstance(other, Command) and self.type == other.type and self.arg1 == other.arg1 and self.arg2 == other.arg2
+
+
+    def __repr__(self):
+        return " ".join(str(arg) for arg in [self.type, self.arg1, self.arg2] if arg != None)
+
+
+
+class Function:
+    __slots__ = ("name", "className", "nVars", "blocks")
+
+    def __init__(self, name, className, nVars=0):
+        # commands before the first function of a file end up in a function without a name
+        self.name = name
+        self.className = className
+        self.nVars = nVars
+        self.blocks = []
+
+
+    def commands(self):
+        for block in self.blocks:
+            yield from block
+
+
+    def setCommands(self, commands):
+        # a block starts at a label and ends after a jump or return
+        self.blocks = []
+        block = []
+        for command in commands:
+            if command.type == C_LABEL and block:
+                self.blocks.append(block)
+                block = []
+            block.append(command)
+            if command.type in [C_GOTO, C_IF, C_RETURN, C_TAILCALL]:
+                self.blocks.append(block)
+                block = []
+        if block:
+            self.blocks.append(block)
+
+
+
+def readFile(file):
+    parser = Parser(file)
+    className = os.path.basename(file).split('.')[0]
+    functions = [Function(None, className)]
+    commands = []
+
+    while parser.hasMoreCommands():
+        parser.advance()
+        commandType = parser.commandType()
+        if commandType == C_FUNCTION:
+            functions[-1].setCommands(commands)
+            functions.append(Function(parser.arg1(), className, int(parser.arg2())))
+            commands = []
+        elif commandType == C_ARITHMETIC:
+            commands.append(Command(commandType, parser.currentCommand[0]))
+        else:
+            arg2 = parser.arg2()
+            commands.append(Command(commandType, parser.arg1(), int(arg2) if arg2 != None else None))
+    functions[-1].setCommands(commands)
+
+    return [function for function in functions if function.name != None or function.blocks]
+
+
+
+#====================== Passes ==========================
+unaryOperations = {
+    "neg": lambda x: -x & 0xFFFF,
+    "not": lambda x: ~x & 0xFFFF
+}
+
+binaryOperations = {
+    "add": lambda x, y: (x + y) & 0xFFFF,
+    "sub": lambda x, y: (x - y) & 0xFFFF,
+    "and": lambda x, y: x & y,
+    "or":  lambda x, y: x | y,
+    # comparisons look at x - y, which can overflow on Hack as well
+    "eq":  lambda x, y: 0xFFFF if x == y else 0,
+    "gt":  lambda x, y: 0xFFFF if 0 < (x - y) & 0xFFFF < 0x8000 else 0,
+    "lt":  lambda x, y: 0xFFFF if (x - y) & 0xFFFF >= 0x8000 else 0
+}
+
+
+def constantAt(commands, i):
+    # a push constant, optionally negated or inverted, as a 16-bit value and the number of commands
+    if i >= len(commands) or commands[i].type != C_PUSH or commands[i].arg1 != "constant":
+        return None, 0
+    value = commands[i].arg2
+    if i + 1 < len(commands) and commands[i + 1].type == C_ARITHMETIC and commands[i + 1].arg1 in unaryOperations:
+        return unaryOperations[commands[i + 1].arg1](value), 2
+    return value, 1
+
+
+def pushConstant(value):
+    # only 0 to 32767 can be pushed directly, everything else is the inverse of one of those
+    if value < 0x8000:
+        return [Command(C_PUSH, "constant", value)]
+    return [Command(C_PUSH, "constant", value ^ 0xFFFF), Command(C_ARITHMETIC, "not")]
+
+
+def foldConstants(function):
+    changed = False
+    for block in function.blocks:
+        i = 0
+        while i < len(block):
+            x, n = constantAt(block, i)
+            if n == 0:
+                i += 1
+                continue
+            y, m = constantAt(block, i + n)
+            next = block[i + n] if i + n < len(block) else None
+            operation = block[i + n + m] if m and i + n + m < len(block) else None
+
+            replacement = None
+            if operation != None and operation.type == C_ARITHMETIC and operation.arg1 in binaryOperations:
+                replacement, n = pushConstant(binaryOperations[operation.arg1](x, y)), n + m + 1
+            elif next != None and next.type == C_ARITHMETIC and next.arg1 in unaryOperations and len(pushConstant(unaryOperations[next.arg1](x))) < n + 1:
+                replacement, n = pushConstant(unaryOperations[next.arg1](x)), n + 1
+            elif next != None and next.type == C_IF:
+                replacement, n = [Command(C_GOTO, next.arg1)] if x else [], n + 1
+            elif len(pushConstant(x)) < n:
+                replacement = pushConstant(x)
+
+            if replacement == None:
+                i += 1
+                continue
+            block[i:i + n] = replacement
+            changed = True
+    return changed
+
+
+def removeRedundant(function):
+    changed = False
+    for block in function.blocks:
+        i = 0
+        while i + 1 < len(block):
+            first, second = block[i], block[i + 1]
+            # pushing a value and popping it back to where it came from, or negating twice
+            if (first.type == C_PUSH and second.type == C_POP and first.arg1 == second.arg1 and first.arg2 == second.arg2) or \
+               (first.type == C_ARITHMETIC and first.arg1 in unaryOperations and first == second):
+                del block[i:i + 2]
+                changed = True
+                i = max(i - 1, 0)
+            else:
+                i += 1
+    return changed
+
+
+def removeDeadCode(function):
+    # a block without a label after a goto or return can't be reached, neither can the rest of its
+    # own block, and a goto to the label right after it is a no-op
+    commands = []
+    for block in function.blocks:
+        if not block:
+            continue
+        if commands and commands[-1].type in [C_GOTO, C_RETURN, C_TAILCALL] and block[0].type != C_LABEL:
+            continue
+        for command in block:
+            commands.append(command)
+            if command.type in [C_GOTO, C_RETURN, C_TAILCALL]:
+                break
+    commands = [command for i, command in enumerate(commands)
+                if not (command.type == C_GOTO and i + 1 < len(commands) and commands[i + 1] == Command(C_LABEL, command.arg1))]
+
+    changed = commands != list(function.commands())
+    if changed:
+        function.setCommands(commands)
+    return changed
+
+
+
+def removeUnusedFunctions(functions, entry="Sys.init"):
+    # keeps what can be reached through calls from the entry and from code outside of functions,
+    # without an entry nothing is known about what gets called, so everything stays
+    byName = {function.name: function for function in functions if function.name != None}
+    if entry not in byName:
+        print(f"no {entry} to start from, unused functions are not removed")
+        return functions
+
+    reachable = set()
+    work = [byName[entry]] + [function for function in functions if function.name == None]
+    while work:
+        function = work.pop()
+        for command in function.commands():
+            if command.type in [C_CALL, C_TAILCALL] and command.arg1 not in reachable and command.arg1 in byName:
+                reachable.add(command.arg1)
+                work.append(byName[command.arg1])
+    reachable.add(entry)
+
+    removed = sorted(name for name in byName if name not in reachable)
+    print(f"removed {len(removed)} of {len(byName)} functions: " + ", ".join(removed))
+    return [function for function in functions if function.name == None or function.name in reachable]
+
+
+
+def isBalanced(commands):
+    # true if every return leaves exactly the return value on the working stack and every label is
+    # reached with the same number of values, only then can the body run on the caller's stack
+    depths = {}
+    depth = 0
+    for command in commands:
+        if command.type == C_LABEL:
+            if depth == None:
+                depth = depths.get(command.arg1)
+                if depth == None:
+                    return False
+            elif depths.setdefault(command.arg1, depth) != depth:
+                return False
+        elif depth == None:
+            continue
+        elif command.type in [C_GOTO, C_IF]:
+            depth -= command.type == C_IF
+            if depth < 0 or depths.setdefault(command.arg1, depth) != depth:
+                return False
+            if command.type == C_GOTO:
+                depth = None
+        elif command.type == C_RETURN:
+            if depth != 1:
+                return False
+            depth = None
+        else:
+            if command.type == C_PUSH:
+                depth += 1
+            elif command.type == C_POP or command.arg1 in binaryOperations:
+                depth -= 1
+            if depth < 0:
+                return False
+    return depth == None
+
+
+
+class Inliner:
+    def __init__(self, maxSize=16, branches=True):
+        # functions with at most maxSize commands that don't call anything are inlined,
+        # with branches=False only straight code without labels
+        self.maxSize = maxSize
+        self.branches = branches
+
+
+    def canInline(self, function):
+        commands = list(function.commands())
+        if function.name == None or len(commands) > self.maxSize or not isBalanced(commands):
+            return False
+        for command in commands:
+            if command.type in [C_CALL, C_TAILCALL] or (command.type == C_LABEL and not self.branches):
+                return False
+            if command.type in [C_PUSH, C_POP] and command.arg1 == "local" and command.arg2 >= function.nVars:
+                return False
+        return True
+
+
+    def __call__(self, functions):
+        callees = {function.name: function for function in functions if self.canInline(function)}
+        # code outside of functions has no frame to put the callee's variables in, neither has
+        # Sys.init, the bootstrap jumps there without setting up LCL
+        for function in functions:
+            if function.name not in [None, "Sys.init"] and any(command.type == C_CALL and command.arg1 in callees for command in function.commands()):
+                self.inlineCalls(function, callees)
+        return functions
+
+
+    def inlineCalls(self, caller, callees):
+        # the arguments and locals of the callee become extra locals of the caller, after its own
+        base = caller.nVars
+        extra = 0
+        commands = []
+        for command in caller.commands():
+            callee = callees.get(command.arg1) if command.type == C_CALL else None
+            if callee == None or any(other.type in [C_PUSH, C_POP] and other.arg1 == "argument" and other.arg2 >= command.arg2
+                                     for other in callee.commands()):
+                commands.append(command)
+                continue
+            expansion, size = self.expand(callee, command.arg2, base, f"{callee.name}.inline{len(commands)}", caller.className)
+            commands += expansion
+            extra = max(extra, size)
+        caller.nVars += extra
+        caller.setCommands(commands)
+
+
+    def expand(self, callee, nArgs, base, prefix, className):
+        locals = base + nArgs
+        pointers = sorted(set(command.arg2 for command in callee.commands() if command.type == C_POP and command.arg1 == "pointer"))
+        saves = locals + callee.nVars
+
+        commands = [Command(C_POP, "local", base + i) for i in reversed(range(nArgs))]
+        for i in range(callee.nVars):
+            commands += [Command(C_PUSH, "constant", 0), Command(C_POP, "local", locals + i)]
+        # THIS and THAT would be restored by the return
+        for i, pointer in enumerate(pointers):
+            commands += [Command(C_PUSH, "pointer", pointer), Command(C_POP, "local", saves + i)]
+
+        for command in callee.commands():
+            if command.type == C_RETURN:
+                commands.append(Command(C_GOTO, f"{prefix}.END"))
+            elif command.type in [C_LABEL, C_GOTO, C_IF]:
+                commands.append(Command(command.type, f"{prefix}.{command.arg1}"))
+            elif command.arg1 == "argument":
+                commands.append(Command(command.type, "local", base + command.arg2))
+            elif command.arg1 == "local":
+                commands.append(Command(command.type, "local", locals + command.arg2))
+            elif command.arg1 == "static" and callee.className != className:
+                commands.append(Command(command.type, "static", f"{callee.className}.{command.arg2}"))
+            else:
+                commands.append(Command(command.type, command.arg1, command.arg2))
+
+        commands.append(Command(C_LABEL, f"{prefix}.END"))
+        for i, pointer in enumerate(pointers):
+            commands += [Command(C_PUSH, "local", saves + i), Command(C_POP, "pointer", pointer)]
+        return commands, nArgs + callee.nVars + len(pointers)
+
+
+
+def eliminateTailCalls(functions):
+    # "call f n" right before "return" becomes a jump to f that reuses the frame of the returning
+    # function. f's arguments have to fit where the returning function's own arguments were, how
+    # many it has is only known from the calls to it.
+    nArgs = {}
+    for function in functions:
+        for command in function.commands():
+            if command.type in [C_CALL, C_TAILCALL]:
+                nArgs.setdefault(command.arg1, set()).add(command.arg2)
+
+    for function in functions:
+        # Sys.init has no frame, the bootstrap jumps there
+        if function.name in [None, "Sys.init"] or len(nArgs.get(function.name, [])) != 1:
+            continue
+        available = min(nArgs[function.name])
+        commands = []
+        for command in function.commands():
+            # the return after a tail call is never reached
+            if command.type == C_RETURN and commands and commands[-1].type == C_CALL and commands[-1].arg2 <= available:
+                commands[-1] = Command(C_TAILCALL, commands[-1].arg1, commands[-1].arg2)
+            else:
+                commands.append(command)
+        function.setCommands(commands)
+    return functions
+
+
+
+class PassManager:
+    def __init__(self, passes=None, programPasses=()):
+        # function passes work on one function at a time, program passes get and return the list of all of them
+        self.passes = passes if passes != None else [foldConstants, removeRedundant, removeDeadCode]
+        self.programPasses = programPasses
+
+
+    def run(self, functions):
+        for optimization in self.programPasses:
+            functions = optimization(functions)
+
+        # every pass only ever shrinks a function, so repeating them until nothing changes terminates
+        for function in functions:
+            changed = True
+            while changed:
+                changed = False
+                for optimization in self.passes:
+                    changed = optimization(function) or changed
+        return functions
+
+
+
+segmentPointers = {
+    "local": "LCL",
+    "argument": "ARG",
+    "this": "THIS", 
+    "that": "THAT"
+}
+
+
 def pushD(D=""):
     return D + """
         @SP
@@ -81,6 +468,10 @@ def pushD(D=""):
         M=M+1
     """
 
+# number of instructions the CodeWriter holds before writing them out
+BATCH_SIZE = 1 << 12
+
+
 def pushVar(Var):
     return pushD(f"""
         @{Var}
@@ -89,19 +480,55 @@ def pushVar(Var):
 
 
 class CodeWriter:
-    def __init__(self, outputFile):
-        self.output = open(outputFile, "w+")
+    def __init__(self, outputFile=None, compact=False, cacheTop=False):
+        # stripped instructions are written to the outputFile in batches, without one they are collected and returned by close
+        self.outputFile = outputFile
+        self.output = open(outputFile, "w+") if outputFile != None else io.StringIO()
+        self.instructions = []
         self.currentClass = None
         self.currentFunction = None
         self.counter = 0
+        # in compact mode call, return and comparisons jump to routines shared by all sites
+        self.compact = compact
+        # with cacheTop the top of the stack can live in D (top == "D") or be a constant that
+        # wasn't loaded yet (top is an int) instead of RAM[SP - 1]; top is None if it is in RAM
+        self.cacheTop = cacheTop
+        self.top = None
+
+
+    def emit(self, translation):
+        # hack instructions never contain whitespace, so splitting the templates on it
+        # drops their indentation and blank lines and leaves one instruction per item
+        self.instructions.extend(translation.split())
+        if len(self.instructions) >= BATCH_SIZE:
+            self.flush()
+
+
+    def flush(self):
+        if self.instructions:
+            self.output.writelines(("\n".join(self.instructions), "\n"))
+            self.instructions.clear()
 
 
     def close(self):
+        self.emit(self.flushTop())
+        self.flush()
+        code = self.output.getvalue() if self.outputFile == None else None
         self.output.close()
+        return code
 
 
     def setFileName(self, filename):
+        self.emit(self.flushTop())
         self.currentClass = os.path.basename(filename).split('.')[0]
+        # labels are numbered per file, so the code of a file doesn't depend on the files before it
+        self.currentFunction = None
+        self.counter = 0
+
+
+    def labelScope(self):
+        # code outside of functions is scoped to its file, so its labels don't collide with another file's
+        return self.currentFunction if self.currentFunction != None else self.currentClass
 
 
     def writeInit(self):
@@ -114,10 +541,236 @@ class CodeWriter:
             @Sys.init
             0;JMP
         """
-        self.output.write(bootstrapCode)
+        if self.compact:
+            bootstrapCode += self.sharedRoutines()
+        self.emit(bootstrapCode)
+
+
+    def writeSharedRoutines(self):
+        # without the bootstrap, execution starts at the top, so it has to skip the routines
+        self.emit("""
+            @$END_SHARED_ROUTINES
+            0;JMP
+        """ + self.sharedRoutines() + """
+            ($END_SHARED_ROUTINES)
+        """)
+
+
+    def sharedRoutines(self):
+        # $CALL expects the return address in D, nArgs in R14 and the function in R15
+        routines = """
+            ($CALL)
+        """
+        routines += pushD() + pushVar("LCL") + pushVar("ARG") + pushVar("THIS") + pushVar("THAT")
+        routines += """
+            @SP
+            D=M
+            @LCL
+            M=D
+
+            @R14
+            D=D-M
+            @5
+            D=D-A
+            @ARG
+            M=D
+
+            @R15
+            A=M
+            0;JMP
+
+            ($RETURN)
+        """
+        routines += self.returnCode()
+
+        # $COMPARE.XX expects the return address in D and replaces x, y on the stack with x XX y
+        for cond in ["EQ", "GT", "LT"]:
+            routines += f"""
+                ($COMPARE.{cond})
+                @R15
+                M=D
+
+                @SP
+                AM=M-1
+                D=M
+                A=A-1
+                D=M-D
+                @$COMPARE.TRUE
+                D;J{cond}
+                @$COMPARE.FALSE
+                0;JMP
+            """
+        routines += """
+            ($COMPARE.TRUE)
+            @SP
+            A=M-1
+            M=-1
+            @R15
+            A=M
+            0;JMP
+
+            ($COMPARE.FALSE)
+            @SP
+            A=M-1
+            M=0
+            @R15
+            A=M
+            0;JMP
+        """
+        return routines
+
+
+    def flushTop(self):
+        # moves a cached stack top back to RAM
+        translation = ""
+        if self.top == "D":
+            translation = pushD()
+        elif self.top != None:
+            translation = pushD(self.loadConstant(self.top))
+        self.top = None
+        return translation
+
+
+    def topToD(self):
+        # moves the top of the stack into D and pops it, it stays cached there
+        if self.top == None:
+            translation = """
+                @SP
+                AM=M-1
+                D=M
+            """
+        elif self.top == "D":
+            translation = ""
+        else:
+            translation = self.loadConstant(self.top)
+        self.top = "D"
+        return translation
+
+
+    def loadConstant(self, value):
+        if value in [0, 1]:
+            return f"""
+                D={value}
+            """
+        return f"""
+            @{value}
+            D=A
+        """
+
+
+    def cachedArithmetic(self, command):
+        if command in ["neg", "not"]:
+            return self.topToD() + ("D=-D\n" if command == "neg" else "D=!D\n")
+
+        if command in ["add", "sub", "and", "or"] and self.top not in [None, "D"]:
+            # x is still in RAM, y is a constant that never has to go through the stack
+            translation = f"""
+                @SP
+                AM=M-1
+                D=M
+                @{self.top}
+            """
+            self.top = "D"
+            return translation + {"add": "D=D+A", "sub": "D=D-A", "and": "D=D&A", "or": "D=D|A"}[command] + "\n"
+
+        # y goes to D, x is popped from RAM
+        translation = self.topToD() + """
+            @SP
+            AM=M-1
+        """
+        if command in ["add", "sub", "and", "or"]:
+            return translation + {"add": "D=D+M", "sub": "D=M-D", "and": "D=D&M", "or": "D=D|M"}[command] + "\n"
+
+        cond = command.upper()
+        label = f"{self.currentClass}${cond}.{self.counter}"
+        self.counter += 1
+        return translation + f"""
+            D=M-D
+            @{label}
+            D;J{cond}
+            D=0
+            @NOT_{label}
+            0;JMP
+            ({label})
+            D=-1
+            (NOT_{label})
+        """
+
+
+    def staticVariable(self, index):
+        # inlined code keeps the statics of its own class, their index comes as "Class.index"
+        return str(index) if "." in str(index) else f"{self.currentClass}.{index}"
+
+
+    def cachedPushPop(self, command, segment, index):
+        if segment != "static":
+            index = int(index)
+        if segment in segmentPointers:
+            address = [f"@{segmentPointers[segment]}", "A=M"] + ["A=A+1"] * index
+        elif segment == "static":
+            address = [f"@{self.staticVariable(index)}"]
+        elif segment == "temp":
+            address = [f"@{5 + index}"]
+        elif segment == "pointer":
+            address = ["@THIS" if index == 0 else "@THAT"]
+
+        if command == C_PUSH:
+            translation = self.flushTop()
+            if segment == "constant":
+                self.top = index
+                return translation
+            self.top = "D"
+            if segment in segmentPointers and index > 2:
+                return translation + f"""
+                    @{index}
+                    D=A
+                    @{segmentPointers[segment]}
+                    A=D+M
+                    D=M
+                """
+            return translation + "\n".join(address) + "\nD=M\n"
+
+        translation = self.topToD()
+        self.top = None
+        if segment in segmentPointers and index > 6:
+            # the value has to wait in R13 while the address is computed
+            return translation + f"""
+                @R13
+                M=D
+                @{index}
+                D=A
+                @{segmentPointers[segment]}
+                D=D+M
+                @R14
+                M=D
+                @R13
+                D=M
+                @R14
+                A=M
+                M=D
+            """
+        return translation + "\n".join(address) + "\nM=D\n"
 
 
     def writeArithmetic(self, command):
+        if self.cacheTop and not (self.compact and command in ["eq", "gt", "lt"]):
+            self.emit(self.cachedArithmetic(command))
+            return
+
+        self.emit(self.flushTop())
+        if self.compact and command in ["eq", "gt", "lt"]:
+            cond = command.upper()
+            label = f"{self.currentClass}${cond}.{self.counter}"
+            self.counter += 1
+            self.emit(f"""
+                @{label}
+                D=A
+                @$COMPARE.{cond}
+                0;JMP
+                ({label})
+            """)
+            return
+
         # if 2 args are given this is in fact y else it is x, because of the code below
         translation = """
             @SP
@@ -144,7 +797,7 @@ class CodeWriter:
             translation += "M=-M\n"
         elif command in ["eq", "gt", "lt"]:
             cond = command.upper()
-            label =  cond + "." + str(self.counter)
+            label = f"{self.currentClass}${cond}.{self.counter}"
             self.counter += 1
             translation += f"""
                 A=M
@@ -176,16 +829,13 @@ class CodeWriter:
             @SP
             M=M+1
         """
-        self.output.write(translation)
+        self.emit(translation)
 
 
     def writePushPop(self, command, segment, index):
-        segmentPointers = {
-            "local": "LCL",
-            "argument": "ARG",
-            "this": "THIS", 
-            "that": "THAT"
-        }
+        if self.cacheTop:
+            self.emit(self.cachedPushPop(command, segment, index))
+            return
 
         translation = ""
         if segment in segmentPointers.keys():
@@ -202,7 +852,7 @@ class CodeWriter:
             """
         elif segment == "static":
             translation += f"""
-                @{self.currentClass}.{index}
+                @{self.staticVariable(index)}
             """
         elif segment == "temp":
             translation += f"""
@@ -213,7 +863,7 @@ class CodeWriter:
             """
         elif segment == "pointer":
             translation += f"""
-                @{ "THIS" if index == "0" else "THAT" }
+                @{ "THIS" if int(index) == 0 else "THAT" }
                 """
 
         if command == C_PUSH:
@@ -237,35 +887,47 @@ class CodeWriter:
             """
 
 
-        self.output.write(translation)
+        self.emit(translation)
 
 
     def writeLabel(self, label):
-        self.output.write(f"""
-            ({self.currentFunction}${label})
+        # other code jumping here can't know what would be cached
+        self.emit(self.flushTop())
+        self.emit(f"""
+            ({self.labelScope()}${label})
         """)
 
 
     def writeGoto(self, label):
-        self.output.write(f"""
-            @{self.currentFunction}${label}
+        self.emit(self.flushTop())
+        self.emit(f"""
+            @{self.labelScope()}${label}
             0;JMP
         """)
 
 
     def writeIf(self, label):
         # cond is true, if its != zero
-        self.output.write(f"""
+        if self.cacheTop:
+            self.emit(self.topToD() + f"""
+                @{self.labelScope()}${label}
+                D;JNE
+            """)
+            self.top = None
+            return
+
+        self.emit(f"""
             @SP
             M=M-1
             A=M
             D=M
-            @{self.currentFunction}${label}
+            @{self.labelScope()}${label}
             D;JNE
         """)
 
 
     def writeFunction(self, functionName, nVars):
+        self.emit(self.flushTop())
         self.currentFunction = functionName
         translation = f"""
             ({functionName})
@@ -276,16 +938,36 @@ class CodeWriter:
                 D=A
             """)
 
-        self.output.write(translation)
+        self.emit(translation)
 
 
     def writeCall(self, functionName, nArgs):
-        returnAddress = f"{self.currentFunction}$ret.{self.counter}"
+        self.emit(self.flushTop())
+        returnAddress = f"{self.labelScope()}$ret.{self.counter}"
+        self.counter += 1
+
+        if self.compact:
+            self.emit(f"""
+                @{nArgs}
+                D=A
+                @R14
+                M=D
+                @{functionName}
+                D=A
+                @R15
+                M=D
+                @{returnAddress}
+                D=A
+                @$CALL
+                0;JMP
+                ({returnAddress})
+            """)
+            return
+
         translation = pushD(f"""
             @{returnAddress}
             D=A
         """)
-        self.counter += 1
 
         translation += pushVar("LCL") + pushVar("ARG") + pushVar("THIS") + pushVar("THAT")
         translation += f"""
@@ -307,12 +989,92 @@ class CodeWriter:
             ({returnAddress})
         """
 
-        self.output.write(translation)
+        self.emit(translation)
+
+
+    def writeTailCall(self, functionName, nArgs):
+        # the returning function's saved frame moves down to right after the new arguments, the
+        # arguments follow it to ARG, copying upwards can't overwrite anything still needed as
+        # long as there are at most as many new arguments as old ones
+        self.emit(self.flushTop())
+        translation = f"""
+            @LCL
+            D=M
+            @5
+            D=D-A
+            @R13
+            M=D
+            @{nArgs}
+            D=A
+            @ARG
+            D=D+M
+            @R14
+            M=D
+        """
+        copyWord = """
+            @R13
+            M=M+1
+            A=M-1
+            D=M
+            @R14
+            M=M+1
+            A=M-1
+            M=D
+        """
+        translation += copyWord * 5
+        if int(nArgs) > 0:
+            translation += f"""
+                @{nArgs}
+                D=A
+                @SP
+                D=M-D
+                @R13
+                M=D
+                @ARG
+                D=M
+                @R14
+                M=D
+            """ + copyWord * int(nArgs)
+        translation += f"""
+            @ARG
+            D=M
+            @{int(nArgs) + 5}
+            D=D+A
+            @SP
+            M=D
+            @LCL
+            M=D
+            @{functionName}
+            0;JMP
+        """
+        self.emit(translation)
 
 
     def writeReturn(self):
+        if self.cacheTop and not self.compact:
+            self.emit(self.topToD() + self.returnCode(valueInD=True))
+            self.top = None
+            return
+
+        self.emit(self.flushTop())
+        if self.compact:
+            self.emit("""
+                @$RETURN
+                0;JMP
+            """)
+        else:
+            self.emit(self.returnCode())
+
+
+    def returnCode(self, valueInD=False):
         # R13 is the endFrame, R14 the return address
-        translation = """
+        translation = ""
+        if valueInD:
+            translation += """
+                @R15
+                M=D
+            """
+        translation += """
             @LCL
             D=M
             @R13
@@ -323,11 +1085,17 @@ class CodeWriter:
             D=M
             @R14
             M=D
-
+        """
+        translation += """
+            @R15
+            D=M
+        """ if valueInD else """
             @SP
             M=M-1
             A=M
             D=M
+        """
+        translation += """
             @ARG
             A=M
             M=D
@@ -351,57 +1119,198 @@ class CodeWriter:
             0;JMP
         """
 
-        self.output.write(translation)
+        return translation
 
 
 
-def main():
-    input = sys.argv[1]
+def writeCommand(command, codeWriter):
+    if command.type in [C_PUSH, C_POP]:
+        codeWriter.writePushPop(command.type, command.arg1, command.arg2)
+    elif command.type == C_ARITHMETIC:
+        codeWriter.writeArithmetic(command.arg1)
+    elif command.type == C_LABEL:
+        codeWriter.writeLabel(command.arg1)
+    elif command.type == C_GOTO:
+        codeWriter.writeGoto(command.arg1)
+    elif command.type == C_IF:
+        codeWriter.writeIf(command.arg1)
+    elif command.type == C_CALL:
+        codeWriter.writeCall(command.arg1, command.arg2)
+    elif command.type == C_TAILCALL:
+        codeWriter.writeTailCall(command.arg1, command.arg2)
+    elif command.type == C_RETURN:
+        codeWriter.writeReturn()
 
-    def parseWriteLogic(file, codeWriter):
-        parser = Parser(file)
-        codeWriter.setFileName(file)
 
-        while parser.hasMoreCommands():
-            parser.advance()
-            commandType = parser.commandType()
-            arg1 = parser.arg1()
-            arg2 = parser.arg2()
+def writeFunctions(functions, codeWriter):
+    for function in functions:
+        if function.className != codeWriter.currentClass:
+            codeWriter.setFileName(function.className)
+        if function.name != None:
+            codeWriter.writeFunction(function.name, function.nVars)
+        for command in function.commands():
+            writeCommand(command, codeWriter)
 
-            if commandType in [C_PUSH, C_POP]:
-                codeWriter.writePushPop(commandType, arg1, arg2)
-            elif commandType ==  C_ARITHMETIC:
-                codeWriter.writeArithmetic(parser.currentCommand[0])
-            elif commandType == C_LABEL:
-                codeWriter.writeLabel(arg1)
-            elif commandType == C_GOTO:
-                codeWriter.writeGoto(arg1)
-            elif commandType == C_IF:
-                codeWriter.writeIf(arg1)
-            elif commandType == C_FUNCTION:
-                codeWriter.writeFunction(arg1, arg2)
-            elif commandType == C_CALL:
-                codeWriter.writeCall(arg1, arg2)
-            elif commandType == C_RETURN:
-                codeWriter.writeReturn()
 
+def translateFile(file, codeWriter, passManager=None):
+    functions = readFile(file)
+    if passManager != None:
+        functions = passManager.run(functions)
+    writeFunctions(functions, codeWriter)
+
+
+
+def translateFragment(file, compact=False, cacheTop=False, optimize=False):
+    # the code of a single file on its own, it only depends on the file and the options
+    codeWriter = CodeWriter(None, compact, cacheTop)
+    translateFile(file, codeWriter, PassManager() if optimize else None)
+    return codeWriter.close()
+
+
+
+class TranslationCache:
+    def __init__(self, directory, options):
+        # a changed translator invalidates everything, so its own source is part of every key
+        with open(__file__, "rb") as translator:
+            self.salt = translator.read() + repr(options).encode()
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+
+    def path(self, file):
+        className = os.path.basename(file).split('.')[0]
+        with open(file, "rb") as source:
+            key = hashlib.sha1(self.salt + className.encode() + b"\0" + source.read()).hexdigest()
+        return os.path.join(self.directory, f"{className}.{key}.asm")
+
+
+    def lookup(self, file):
+        path = self.path(file)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        self.hits += 1
+        with open(path, "r") as cached:
+            return cached.read()
+
+
+    def store(self, file, fragment):
+        path = self.path(file)
+        # older versions of the file won't be needed anymore
+        className = os.path.basename(path).split('.')[0]
+        for stale in glob.glob(os.path.join(glob.escape(self.directory), f"{className}.*.asm")):
+            os.remove(stale)
+        # an interrupted run must not leave half a fragment behind
+        with open(path + ".tmp", "w+") as cached:
+            cached.write(fragment)
+        os.replace(path + ".tmp", path)
+
+
+
+def translateFiles(files, workers=1, cache=None, compact=False, cacheTop=False, optimize=False):
+    # the fragments of all files in the given order, from the cache where possible, the others are
+    # translated on a pool of workers processes (all cores for None)
+    fragments = [cache.lookup(file) if cache != None else None for file in files]
+    missing = [file for file, fragment in zip(files, fragments) if fragment == None]
+
+    if workers == 1 or len(missing) < 2:
+        translated = [translateFragment(file, compact, cacheTop, optimize) for file in missing]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            translated = list(pool.map(translateFragment, missing, itertools.repeat(compact), itertools.repeat(cacheTop), itertools.repeat(optimize)))
+
+    translated = dict(zip(missing, translated))
+    if cache != None:
+        for file, fragment in translated.items():
+            cache.store(file, fragment)
+    return [fragment if fragment != None else translated[file] for file, fragment in zip(files, fragments)]
+
+
+
+def assemble(instructions, filePath, rom=False):
+    # hands the instructions to the assembler in 06 directly, without an .asm file in between
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "06"))
+    import MyAssembler
+
+    words = MyAssembler.Parser()(instructions)
+    if rom:
+        with open(MyAssembler.output_path(filePath, rom), "wb") as output:
+            MyAssembler.write_rom(words, output)
+    else:
+        with open(MyAssembler.output_path(filePath, rom), "w+") as output:
+            output.writelines(MyAssembler.hack_lines(words))
+
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    flags = [arg for arg in sys.argv[1:] if arg.startswith("--")]
+    input = args[0]
+    compact = "--compact" in flags
+    cacheTop = "--cache-top" in flags
+    dce = "--dce" in flags
+    # --hack and --rom assemble the program right away instead of writing the .asm file
+    assembled = "--hack" in flags or "--rom" in flags
+
+    # --inline-size=N and --inline-no-branches imply --inline
+    programPasses = []
+    inlineSize = [int(flag.split("=")[1]) for flag in flags if flag.startswith("--inline-size=")]
+    if "--inline" in flags or inlineSize or "--inline-no-branches" in flags:
+        programPasses.append(Inliner(inlineSize[-1] if inlineSize else 16, "--inline-no-branches" not in flags))
+    if "--tco" in flags:
+        programPasses.append(eliminateTailCalls)
+    if dce:
+        programPasses.append(removeUnusedFunctions)
+
+    # --cache keeps the translation of every file in <dir>/.vmcache, --cache=DIR somewhere else
+    cache = [flag.partition("=")[2] for flag in flags if flag == "--cache" or flag.startswith("--cache=")]
+    # --jobs=N translates the files on N processes, --jobs on all cores
+    workers = 1
+    for flag in flags:
+        if flag == "--jobs":
+            workers = None
+        elif flag.startswith("--jobs="):
+            workers = int(flag[len("--jobs="):])
+    if (cache or workers != 1) and programPasses:
+        raise Exception("--cache and --jobs can't be combined with --inline, --tco or --dce, they need the whole program")
+
+    passManager = None
+    if "--optimize" in flags or programPasses:
+        passManager = PassManager(None if "--optimize" in flags else [], programPasses)
 
     if os.path.isfile(input):
         output = input.replace(".vm", ".asm")
-        codeWriter = CodeWriter(output)
-        parseWriteLogic(input, codeWriter)    
+        codeWriter = CodeWriter(None if assembled else output, compact, cacheTop)
+        if compact:
+            codeWriter.writeSharedRoutines()
+        translateFile(input, codeWriter, passManager)    
     elif os.path.isdir(input):
         output = os.path.join(input, os.path.basename(input) + ".asm")
-        files = [os.path.join(input, file) for file in os.listdir(input) if file.endswith(".vm")]
-        codeWriter = CodeWriter(output)
+        files = sorted(os.path.join(input, file) for file in os.listdir(input) if file.endswith(".vm"))
+        codeWriter = CodeWriter(None if assembled else output, compact, cacheTop)
 
         codeWriter.writeInit()
-        for file in files:
-            parseWriteLogic(file, codeWriter)
+        if cache or workers != 1:
+            # files are translated on their own, the fragments are linked in the order of the files
+            options = (compact, cacheTop, "--optimize" in flags)
+            translationCache = TranslationCache(cache[-1] or os.path.join(input, ".vmcache"), options) if cache else None
+            for fragment in translateFiles(files, workers, translationCache, *options):
+                codeWriter.emit(fragment)
+            if translationCache != None:
+                print(f"{translationCache.hits} files from the cache, {translationCache.misses} translated")
+        else:
+            # program passes need every function at once, so all files are read before anything is written
+            functions = [function for file in files for function in readFile(file)]
+            used = passManager.run(functions) if passManager != None else functions
+            writeFunctions(used, codeWriter)
     else:
         raise Exception("argv[1] is neither a dir nor a file")
 
-    codeWriter.close()
+    code = codeWriter.close()
+    if assembled:
+        assemble(code.splitlines(), output, "--rom" in flags)
 
 
 if __name__ == "__main__":
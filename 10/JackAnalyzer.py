@@ -6,6 +6,11 @@ import functools
 
 keywords = ["class", "method", "function", "constructor", "int", "boolean", "char", "void", "var", "static", "field", "let", "do", "if", "else", "while", "return", "true", "false", "null", "this"]
 symbols = ['(', ')', '+', '-', '/', '*', '<', '>', '=', '&', '|', '~', ';', '.', ',', '[', ']', '{', '}']
+# one alternative per kind of token, the group name is the token type; comments are
+# skipped like whitespace, a comment or string that is never closed is matched by unclosed
+tokenPattern = re.compile(r'(?P<space>\s+)|(?P<comment>//[^\n]*|/\*[\s\S]*?\*/)|(?P<int_const>\d+)|(?P<word>[A-Za-z_]+)|'
+                          r'"(?P<string_const>[^"]*)"|(?P<unclosed>"|/\*)|'
+                          f'(?P<symbol>[{re.escape("".join(symbols))}])|(?P<unknown>.)')
 constants = ["keyword", "symbol", "identifier", "int_const", "string_const"] + keywords
 for constant in constants:
     exec(f"{constant.upper()} = '{constant}'")
@@ -14,56 +19,55 @@ for constant in constants:
 class Tokenizer:
     def __init__(self, file):
         with open(file, "r") as f:
-            unclean = f.read() 
-            self.text = re.sub("(\/\/.*)|(\/\*.*\*\/)", "", unclean)
+            self.text = f.read()
+        self.file = file
         self.currentToken = None
-        self.currentPos = 0
-
-
-    def cc(self):
-        return self.text[self.currentPos] if self.currentPos < len(self.text) else None 
+        # tokens are scanned lazily, one ahead of the current one
+        self.tokens = self.scan()
+        self.nextToken = next(self.tokens, None)
+
+
+    def scan(self):
+        line, lineStart = 1, 0
+        for match in tokenPattern.finditer(self.text):
+            kind = match.lastgroup
+            value = match.group(kind)
+            position = (line, match.start() - lineStart + 1)
+            if "\n" in value:
+                line += value.count("\n")
+                lineStart = match.start(kind) + value.rindex("\n") + 1
+
+            if kind == "space" or kind == "comment":
+                continue
+            elif kind == "word":
+                yield [KEYWORD if value in keywords else IDENTIFIER, value, *position]
+            elif kind == INT_CONST:
+                yield [INT_CONST, int(value), *position]
+            elif kind == "unclosed":
+                raise Exception("Missing " + ('"' if value == '"' else "*/") + " at " + self.location(*position))
+            elif kind == "unknown":
+                raise Exception("Unknown Token " + value + " at " + self.location(*position))
+            else:
+                yield [kind, value, *position]
 
 
     def hasMoreTokens(self):
-        remaining = self.text[self.currentPos:]
-        return len(remaining.split()) > 0
+        return self.nextToken != None
 
-        
-    def advance(self):
-        while self.cc().isspace():
-            self.currentPos += 1 
 
-        if self.currentPos >= len(self.text):
+    def advance(self):
+        if self.nextToken == None:
             raise Exception("EOF")
-        
-        if self.cc().isnumeric():
-            num = 0 
-            while self.cc().isnumeric():
-                num = num * 10 + int(self.cc())
-                self.currentPos += 1
-            self.currentToken = [INT_CONST, num]
-        elif self.cc().isalpha() or self.cc() == '_':
-            name = ""
-            while self.cc().isalpha() or self.cc() == '_':
-                name += self.cc()
-                self.currentPos += 1
-            tokenType = KEYWORD if name in keywords else IDENTIFIER
-            self.currentToken = [tokenType, name]
-        elif self.cc() == '"':
-            string = ""
-            self.currentPos += 1
-            while self.cc() != '"':
-                if self.currentPos >= len(self.text):
-                    raise Exception('Missing "')
-                string += self.cc()
-                self.currentPos += 1
-            self.currentPos += 1
-            self.currentToken = [STRING_CONST, string]
-        elif self.cc() in symbols:
-            self.currentToken = [SYMBOL, self.cc()]
-            self.currentPos += 1
-        else:
-            raise Exception("Unknown Token")
+        self.currentToken = self.nextToken
+        self.nextToken = next(self.tokens, None)
+
+
+    def location(self, line, column):
+        return f"{self.file}:{line}:{column}"
+
+
+    def position(self):
+        return self.location(*self.currentToken[2:])
 
 
     def tokenType(self):
@@ -106,7 +110,7 @@ class CompilationEngine:
             if self.tokenizer.hasMoreTokens():
                 self.tokenizer.advance()
             return
-        raise Exception("Unexpected Token: " + self.tokenizer.keyword() + " of Type " + self.tokenizer.tokenType() + "\nExpected Token: " + expectedToken)
+        raise Exception("Unexpected Token: " + self.tokenizer.keyword() + " of Type " + self.tokenizer.tokenType() + "\nExpected Token: " + expectedToken + "\nat " + self.tokenizer.position())
 
 
     def eatType(self, expectedType):
@@ -115,7 +119,7 @@ class CompilationEngine:
             if self.tokenizer.hasMoreTokens():
                 self.tokenizer.advance()
             return
-        raise Exception("Unexpected Token: " + self.tokenizer.keyword() + " of Type " + self.tokenizer.tokenType() + "\nExpected Type: " + expectedType)  
+        raise Exception("Unexpected Token: " + self.tokenizer.keyword() + " of Type " + self.tokenizer.tokenType() + "\nExpected Type: " + expectedType + "\nat " + self.tokenizer.position())  
 
 
     def xmlToken(self):
@@ -168,7 +172,7 @@ class CompilationEngine:
             self.xmlToken()
             self.tokenizer.advance()
         else:
-            raise Exception("Expected an Type, but got instead: " + self.tokenizer.keyword())
+            raise Exception("Expected an Type, but got instead: " + self.tokenizer.keyword() + " at " + self.tokenizer.position())
 
         # varName 
         self.eatType(IDENTIFIER)      
@@ -194,7 +198,7 @@ class CompilationEngine:
             self.xmlToken()
             self.tokenizer.advance()
         else:
-            raise Exception("Expected an Type, but got instead: " + self.tokenizer.keyword())
+            raise Exception("Expected an Type, but got instead: " + self.tokenizer.keyword() + " at " + self.tokenizer.position())
 
         # subroutineName
         self.eatType(IDENTIFIER)
@@ -240,7 +244,7 @@ class CompilationEngine:
             self.xmlToken()
             self.tokenizer.advance()
         else:
-            raise Exception("Expected an Type, but got instead: " + self.tokenizer.keyword())
+            raise Exception("Expected an Type, but got instead: " + self.tokenizer.keyword() + " at " + self.tokenizer.position())
         # varName
         self.eatType(IDENTIFIER)
         
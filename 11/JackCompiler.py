@@ -1,10 +1,17 @@
 import sys
 import os
 import re
+import itertools
+import concurrent.futures
 
 
 keywords = ["class", "method", "function", "constructor", "int", "boolean", "char", "void", "var", "static", "field", "let", "do", "if", "else", "while", "return", "true", "false", "null", "this"]
 symbols = ['(', ')', '+', '-', '/', '*', '<', '>', '=', '&', '|', '~', ';', '.', ',', '[', ']', '{', '}']
+# one alternative per kind of token, the group name is the token type; comments are
+# skipped like whitespace, a comment or string that is never closed is matched by unclosed
+tokenPattern = re.compile(r'(?P<space>\s+)|(?P<comment>//[^\n]*|/\*[\s\S]*?\*/)|(?P<int_const>\d+)|(?P<word>[A-Za-z_]+)|'
+                          r'"(?P<string_const>[^"]*)"|(?P<unclosed>"|/\*)|'
+                          f'(?P<symbol>[{re.escape("".join(symbols))}])|(?P<unknown>.)')
 KEYWORD = "keyword"
 SYMBOL = "symbol"
 IDENTIFIER = "identifier"
@@ -25,59 +32,55 @@ def kindToSegment(kind):
 class Tokenizer:
     def __init__(self, file):
         with open(file, "r") as f:
-            unclean = f.read() 
-            singleLine = "(\/\/.*)"
-            contentOfMultiLine = "((?!\*\/)(.|\n))*"
-            multiLine = f"(\/\*{contentOfMultiLine}\*\/)"
-            self.text = re.sub(f"{singleLine}|{multiLine}", "", unclean)
+            self.text = f.read()
+        self.file = file
         self.currentToken = None
-        self.currentPos = 0
-
-
-    def cc(self):
-        return self.text[self.currentPos] if self.currentPos < len(self.text) else None 
+        # tokens are scanned lazily, one ahead of the current one
+        self.tokens = self.scan()
+        self.nextToken = next(self.tokens, None)
+
+
+    def scan(self):
+        line, lineStart = 1, 0
+        for match in tokenPattern.finditer(self.text):
+            kind = match.lastgroup
+            value = match.group(kind)
+            position = (line, match.start() - lineStart + 1)
+            if "\n" in value:
+                line += value.count("\n")
+                lineStart = match.start(kind) + value.rindex("\n") + 1
+
+            if kind == "space" or kind == "comment":
+                continue
+            elif kind == "word":
+                yield [KEYWORD if value in keywords else IDENTIFIER, value, *position]
+            elif kind == INT_CONST:
+                yield [INT_CONST, int(value), *position]
+            elif kind == "unclosed":
+                raise Exception("Missing " + ('"' if value == '"' else "*/") + " at " + self.location(*position))
+            elif kind == "unknown":
+                raise Exception("Unknown Token " + value + " at " + self.location(*position))
+            else:
+                yield [kind, value, *position]
 
 
     def hasMoreTokens(self):
-        remaining = self.text[self.currentPos:]
-        return len(remaining.split()) > 0
+        return self.nextToken != None
 
-        
-    def advance(self):
-        while self.cc().isspace():
-            self.currentPos += 1 
 
-        if self.currentPos >= len(self.text):
+    def advance(self):
+        if self.nextToken == None:
             raise Exception("EOF")
-        
-        if self.cc().isnumeric():
-            num = 0 
-            while self.cc().isnumeric():
-                num = num * 10 + int(self.cc())
-                self.currentPos += 1
-            self.currentToken = [INT_CONST, num]
-        elif self.cc().isalpha() or self.cc() == '_':
-            name = ""
-            while self.cc().isalpha() or self.cc() == '_':
-                name += self.cc()
-                self.currentPos += 1
-            tokenType = KEYWORD if name in keywords else IDENTIFIER
-            self.currentToken = [tokenType, name]
-        elif self.cc() == '"':
-            string = ""
-            self.currentPos += 1
-            while self.cc() != '"':
-                if self.currentPos >= len(self.text):
-                    raise Exception('Missing "')
-                string += self.cc()
-                self.currentPos += 1
-            self.currentPos += 1
-            self.currentToken = [STRING_CONST, string]
-        elif self.cc() in symbols:
-            self.currentToken = [SYMBOL, self.cc()]
-            self.currentPos += 1
-        else:
-            raise Exception("Unknown Token")
+        self.currentToken = self.nextToken
+        self.nextToken = next(self.tokens, None)
+
+
+    def location(self, line, column):
+        return f"{self.file}:{line}:{column}"
+
+
+    def position(self):
+        return self.location(*self.currentToken[2:])
 
 
     def tokenType(self):
@@ -106,13 +109,12 @@ class Tokenizer:
 
 
 class SymbolTable:
-    staticCounter = 0
-
     def __init__(self):
         self.classScope = {}
         self.subroutineScope = {}
+        # statics are numbered per class, the VM translator keeps them apart by file name
         self.counter = {
-            'static': SymbolTable.staticCounter,
+            'static': 0,
             'field': 0,
             'arg': 0,
             'var': 0
@@ -128,9 +130,6 @@ class SymbolTable:
         }
         if kind in ['static', 'field']:
             self.classScope[name] = entry
-
-            if kind == 'static':
-                SymbolTable.staticCounter += 1
         else:
             self.subroutineScope[name] = entry
 
@@ -222,11 +221,131 @@ class ParseTreeNode:
 
 
 
+#====================== Simplification ==========================
+def toSigned(value):
+    value &= 0xFFFF
+    return value - 0x10000 if value & 0x8000 else value
+
+
+def constantOf(node):
+    # value of an integer constant, also the negated ones that constantNode builds
+    if node.nodeType == INT_CONST:
+        return toSigned(node.value)
+    if node.nodeType == SYMBOL and node.value in ['- Unary', '~']:
+        value = constantOf(node.children[0])
+        if value != None:
+            return toSigned(-value if node.value == '- Unary' else ~value)
+    return None
+
+
+def constantNode(value):
+    # the VM can only push constants from 0 to 32767
+    if value >= 0:
+        return ParseTreeNode(value, INT_CONST)
+    elif value == -0x8000:
+        return ParseTreeNode('~', SYMBOL, [ParseTreeNode(0x7FFF, INT_CONST)])
+    return ParseTreeNode('- Unary', SYMBOL, [ParseTreeNode(-value, INT_CONST)])
+
+
+def negate(node):
+    if node.nodeType == SYMBOL and node.value == '- Unary':
+        return node.children[0]
+    return ParseTreeNode('- Unary', SYMBOL, [node])
+
+
+def isPure(node):
+    # calls and string constants have side effects, an expression without them can be dropped
+    return node.nodeType not in ['function', STRING_CONST] and all(isPure(child) for child in node.children)
+
+
+def fold(symbol, values):
+    # Jack arithmetic on 16-bit words, comparisons are -1 if true. The VM compares by
+    # the sign of x - y, which can overflow, so folding does the same
+    if len(values) == 1:
+        value = values[0]
+        return toSigned(-value if symbol == '- Unary' else ~value)
+
+    a, b = values
+    if symbol == '/':
+        if b == 0:
+            return None
+        quotient = abs(a) // abs(b)
+        return toSigned(quotient if (a < 0) == (b < 0) else -quotient)
+    switch = {
+        '+': lambda: a + b,
+        '-': lambda: a - b,
+        '*': lambda: a * b,
+        '&': lambda: a & b,
+        '|': lambda: a | b,
+        '<': lambda: -int(toSigned(a - b) < 0),
+        '>': lambda: -int(toSigned(a - b) > 0),
+        '=': lambda: -int(a == b)
+    }
+    return toSigned(switch[symbol]())
+
+
+def simplify(node):
+    # bottom up: constant subexpressions are folded, identities like x+0, x*1 and ~~x
+    # are removed and multiplications with powers of two become doublings
+    node = ParseTreeNode(node.value, node.nodeType, [simplify(child) for child in node.children], node.callingObj)
+    if node.nodeType != SYMBOL:
+        return node
+
+    symbol = node.value
+    values = [constantOf(child) for child in node.children]
+    if None not in values:
+        value = fold(symbol, values)
+        if value != None:
+            return constantNode(value)
+
+    if len(node.children) == 1:
+        child = node.children[0]
+        if child.nodeType == SYMBOL and child.value == symbol:
+            return child.children[0]
+        return node
+
+    x, y = node.children
+    a, b = values
+    if symbol in ['+', '|'] and a == 0:
+        return y
+    elif symbol in ['+', '-', '|'] and b == 0:
+        return x
+    elif symbol == '-' and a == 0:
+        return negate(y)
+    elif symbol == '&' and a == -1:
+        return y
+    elif symbol == '&' and b == -1:
+        return x
+    elif symbol == '/' and b == 1:
+        return x
+    elif symbol == '*':
+        if a != None:
+            x, y, a, b = y, x, b, a
+        if b == None:
+            return node
+        elif b == 0:
+            return constantNode(0) if isPure(x) else node
+        elif b == 1:
+            return x
+        elif b == -1:
+            return negate(x)
+        shift = abs(b).bit_length() - 1
+        if abs(b) == 1 << shift:
+            doubled = ParseTreeNode(shift, 'double', [x])
+            return doubled if b > 0 else negate(doubled)
+    return node
+
+
+
 class CompilationEngine:
-    def __init__(self, vmWriter, tokenizer):
+    def __init__(self, vmWriter, tokenizer, optimize=False, poolStrings=False):
         self.tokenizer = tokenizer
         self.output = vmWriter
         self.symbolTable = SymbolTable()
+        self.optimize = optimize
+        self.poolStrings = poolStrings
+        # string constant -> name of the hidden static it's kept in
+        self.strings = {}
 
         self.className = None
         self.numLabels = 0
@@ -238,7 +357,7 @@ class CompilationEngine:
             if self.tokenizer.hasMoreTokens():
                 self.tokenizer.advance()
             return
-        raise Exception("Unexpected Token: " + str(self.tokenizer.keyword()) + " of Type " + self.tokenizer.tokenType() + "\nExpected Token: " + expectedToken)
+        raise Exception("Unexpected Token: " + str(self.tokenizer.keyword()) + " of Type " + self.tokenizer.tokenType() + "\nExpected Token: " + expectedToken + "\nat " + self.tokenizer.position())
 
 
     def eatType(self, expectedType):
@@ -247,7 +366,7 @@ class CompilationEngine:
             if self.tokenizer.hasMoreTokens():
                 self.tokenizer.advance()
             return value
-        raise Exception("Unexpected Token: " + self.tokenizer.keyword() + " of Type " + self.tokenizer.tokenType() + "\nExpected Type: " + expectedType)  
+        raise Exception("Unexpected Token: " + self.tokenizer.keyword() + " of Type " + self.tokenizer.tokenType() + "\nExpected Type: " + expectedType + "\nat " + self.tokenizer.position())  
 
 
 
@@ -276,7 +395,7 @@ class CompilationEngine:
             type_ = self.tokenizer.keyword()
             self.tokenizer.advance()
         else:
-            raise Exception("Expected an Type, but got instead: " + self.tokenizer.keyword())
+            raise Exception("Expected an Type, but got instead: " + self.tokenizer.keyword() + " at " + self.tokenizer.position())
 
         name = self.eatType(IDENTIFIER)  
         self.symbolTable.define(name, type_, kind)
@@ -304,7 +423,7 @@ class CompilationEngine:
         if self.tokenizer.tokenType() == IDENTIFIER or self.tokenizer.keyword() in ["int", "char", "boolean", "void"]:
             self.tokenizer.advance()
         else:
-            raise Exception("Expected an Type, but got instead: " + self.tokenizer.keyword())
+            raise Exception("Expected an Type, but got instead: " + self.tokenizer.keyword() + " at " + self.tokenizer.position())
 
         subroutineName = self.eatType(IDENTIFIER)
 
@@ -361,7 +480,7 @@ class CompilationEngine:
             type_ = self.tokenizer.keyword()
             self.tokenizer.advance()
         else:
-            raise Exception("Expected an Type, but got instead: " + self.tokenizer.keyword())
+            raise Exception("Expected an Type, but got instead: " + self.tokenizer.keyword() + " at " + self.tokenizer.position())
         
         while True:
             name = self.eatType(IDENTIFIER)
@@ -490,7 +609,7 @@ class CompilationEngine:
 
         self.eat(';')
 
-        self.traverseParseTree(funcNode)
+        self.traverseParseTree(simplify(funcNode) if self.optimize else funcNode)
         self.output.writePop('temp', 0)
 
 
@@ -507,6 +626,8 @@ class CompilationEngine:
 
     def compileExpression(self):
         parseTree = self.cptAnd()
+        if self.optimize:
+            parseTree = simplify(parseTree)
         self.traverseParseTree(parseTree)
 
 
@@ -585,7 +706,7 @@ class CompilationEngine:
             
             return ParseTreeNode(name, 'variable')
         else:
-            raise Exception('No valid Token in Term: ' + self.tokenizer.symbol())
+            raise Exception('No valid Token in Term: ' + str(self.tokenizer.symbol()) + ' at ' + self.tokenizer.position())
 
 
     def cptFunction(self, name):
@@ -647,12 +768,10 @@ class CompilationEngine:
                 command = switch[symbol]
                 self.output.writeArithmetic(command)
         elif nodeType == STRING_CONST:
-            string = parseTree.value
-            self.output.writePush('constant', len(string))
-            self.output.writeCall("String.new", 1)
-            for c in string:
-                self.output.writePush('constant', ord(c))
-                self.output.writeCall("String.appendChar", 2)
+            if self.poolStrings:
+                self.writePooledString(parseTree.value)
+            else:
+                self.writeString(parseTree.value)
         elif nodeType == INT_CONST:
             self.output.writePush('constant', parseTree.value)
         elif nodeType == KEYWORD:
@@ -678,6 +797,13 @@ class CompilationEngine:
             self.output.writeArithmetic('add')
             self.output.writePop('pointer', 1)
             self.output.writePush('that', 0)
+        elif nodeType == 'double':
+            # the value is on the stack, it's added to itself through temp 1
+            for i in range(parseTree.value):
+                self.output.writePop('temp', 1)
+                self.output.writePush('temp', 1)
+                self.output.writePush('temp', 1)
+                self.output.writeArithmetic('add')
         elif nodeType == 'function':
             funcName = parseTree.value
             className = None
@@ -703,23 +829,75 @@ class CompilationEngine:
             self.output.writeCall(f'{className}.{funcName}', nArgs)
 
 
+    def writeString(self, string):
+        self.output.writePush('constant', len(string))
+        self.output.writeCall("String.new", 1)
+        for c in string:
+            self.output.writePush('constant', ord(c))
+            self.output.writeCall("String.appendChar", 2)
 
-def main():
-    inputArg = sys.argv[1]
 
-    def compile_(inputfile):
-        tokenizer = Tokenizer(inputfile)
-        outputfile = inputfile.replace(".jack", ".vm")
-        vmWriter = VMWriter(outputfile)
-        compilationEngine = CompilationEngine(vmWriter, tokenizer)
-        compilationEngine.compileClass()
+    def writePooledString(self, string):
+        # The string is built the first time it's evaluated and then kept in a static,
+        # all constants with the same text in a class share it. "$" can't be part of a
+        # Jack name, so the statics don't collide with the ones the class declares.
+        name = self.strings.get(string)
+        if name == None:
+            name = self.strings[string] = '$str' + str(len(self.strings))
+            self.symbolTable.define(name, 'String', 'static')
+        index = self.symbolTable.indexOf(name) - 1
+
+        labelReady = 'STRING_READY' + str(self.numLabels)
+        self.numLabels += 1
+        self.output.writePush('static', index)
+        self.output.writeIf(labelReady)
+        self.writeString(string)
+        self.output.writePop('static', index)
+        self.output.writeLabel(labelReady)
+        self.output.writePush('static', index)
+
+
+
+def compileFile(inputfile, optimize=False, poolStrings=False):
+    tokenizer = Tokenizer(inputfile)
+    outputfile = inputfile.replace(".jack", ".vm")
+    vmWriter = VMWriter(outputfile)
+    compilationEngine = CompilationEngine(vmWriter, tokenizer, optimize, poolStrings)
+    compilationEngine.compileClass()
+    vmWriter.close()
+    return outputfile
+
+
+def compileFiles(files, workers=1, optimize=False, poolStrings=False):
+    # every class is compiled on its own, so they can be spread over a pool of worker processes (all cores for None)
+    if workers == 1 or len(files) < 2:
+        return [compileFile(file, optimize, poolStrings) for file in files]
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        return list(pool.map(compileFile, files, itertools.repeat(optimize), itertools.repeat(poolStrings)))
+
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    flags = [arg for arg in sys.argv[1:] if arg.startswith("--")]
+    inputArg = args[0]
+    # --optimize folds constants and simplifies expressions before they are written
+    optimize = "--optimize" in flags
+    # --pool-strings builds every string constant only once, the program mustn't change or dispose them
+    poolStrings = "--pool-strings" in flags
+    # --jobs=N compiles the files on N processes, --jobs on all cores
+    workers = 1
+    for flag in flags:
+        if flag == "--jobs":
+            workers = None
+        elif flag.startswith("--jobs="):
+            workers = int(flag[len("--jobs="):])
 
     if os.path.isfile(inputArg):
-        compile_(inputArg)
+        compileFile(inputArg, optimize, poolStrings)
     elif os.path.isdir(inputArg):
-        files = [os.path.join(inputArg, file) for file in os.listdir(inputArg) if file.endswith(".jack")]
-        for file in files:
-            compile_(file)
+        files = sorted(os.path.join(inputArg, file) for file in os.listdir(inputArg) if file.endswith(".jack"))
+        compileFiles(files, workers, optimize, poolStrings)
     else:
         raise Exception("Input was neither file nor directory")
 
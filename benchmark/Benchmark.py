@@ -0,0 +1,280 @@
+import sys
+import os
+import json
+import time
+import random
+import tempfile
+import tracemalloc
+import subprocess
+import importlib.util
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_module(name, path):
+    # the chapters aren't packages, so the tools are loaded straight from their files
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+MyAssembler = load_module("MyAssembler", "06/MyAssembler.py")
+VirtualMachine = load_module("VirtualMachine", "08/VirtualMachine.py")
+JackCompiler = load_module("JackCompiler", "11/JackCompiler.py")
+
+
+# number of instructions, functions or expression depth per workload
+SIZES = {
+    "quick": {"asm": [10000, 100000], "vm": [1000], "jack": [20]},
+    "full": {"asm": [10000, 100000, 1000000], "vm": [1000, 5000], "jack": [50, 100]}
+}
+
+
+def name(i):
+    # the Jack tokenizer only accepts letters in identifiers
+    letters = ""
+    while True:
+        letters += chr(ord('a') + i % 26)
+        i //= 26
+        if i == 0:
+            return letters
+
+
+
+#====================== Workloads ==========================
+def generate_asm(directory, numInstructions, rng):
+    # blocks of 20 instructions in the style of VM translator output, each behind a label;
+    # jumps only target the first 32K words, so programs larger than the ROM still assemble
+    path = os.path.join(directory, f"Program{numInstructions}.asm")
+    numLabels = max(1, numInstructions // 20)
+    targets = min(numLabels, 0x8000 // 20)
+    lines = []
+    for label in range(numLabels):
+        lines += [
+            f"(LOOP.{label})",
+            f"@var.{rng.randrange(200)}",
+            "D=M",
+            "@SP",
+            "AM=M+1",
+            "A=A-1",
+            "M=D",
+            f"@{rng.randrange(32768)}",
+            "D=D+A",
+            "@SP",
+            "M=M-1",
+            "A=M",
+            "M=M+D",
+            f"@LOOP.{rng.randrange(targets)}",
+            "D;JGT",
+            f"@var.{rng.randrange(200)}",
+            "M=D",
+            "@R13",
+            "A=M",
+            f"@LOOP.{rng.randrange(targets)}",
+            "0;JMP"
+        ]
+    with open(path, "w+") as file:
+        file.write("\n".join(lines) + "\n")
+    return path
+
+
+def generate_vm(directory, numFunctions, rng, functionsPerFile=100):
+    path = os.path.join(directory, f"Program{numFunctions}")
+    os.makedirs(path)
+    segments = ["local", "argument", "this", "that", "static", "temp", "constant"]
+    for fileIndex in range(0, numFunctions, functionsPerFile):
+        className = f"Class{fileIndex // functionsPerFile}"
+        lines = []
+        for i in range(fileIndex, min(fileIndex + functionsPerFile, numFunctions)):
+            lines.append(f"function {className}.f{i} 3")
+            for j in range(20):
+                lines.append(f"push {rng.choice(segments)} {rng.randrange(3)}")
+                lines.append(f"push constant {rng.randrange(1000)}")
+                lines.append(rng.choice(["add", "sub", "and", "or", "eq", "gt", "lt"]))
+                lines.append(rng.choice(["neg", "not"]))
+                lines.append(f"if-goto L{j}")
+                lines.append(f"label L{j}")
+                lines.append(f"push constant {rng.randrange(1000)}")
+                lines.append(f"pop {rng.choice(['local', 'temp'])} {rng.randrange(3)}")
+            callee = rng.randrange(numFunctions)
+            lines.append(f"call Class{callee // functionsPerFile}.f{callee} 2")
+            lines.append("return")
+        with open(os.path.join(path, f"{className}.vm"), "w+") as file:
+            file.write("\n".join(lines) + "\n")
+    with open(os.path.join(path, "Sys.vm"), "w+") as file:
+        file.write("function Sys.init 0\ncall Class0.f0 0\nlabel HALT\ngoto HALT\n")
+    return path
+
+
+def generate_expression(depth, rng):
+    # nested depth levels deep on the left, shallow on the right, so the size stays linear
+    if depth == 0:
+        return rng.choice(["a", "b", "c", str(rng.randrange(100))])
+    op = rng.choice(["+", "-", "*", "/", "&", "|", "<", ">", "="])
+    return f"({generate_expression(depth - 1, rng)} {op} {generate_expression(min(depth - 1, 1), rng)})"
+
+
+def generate_jack(directory, depth, rng, numFunctions=50):
+    path = os.path.join(directory, f"Deep{depth}.jack")
+    lines = ["/** generated benchmark class */", "class Deep {", "    static int a;"]
+    for i in range(numFunctions):
+        lines += [
+            f"    // function {i}",
+            f"    function int f{name(i)}(int b, int c) {{",
+            "        var int x;",
+            f"        let x = {generate_expression(depth, rng)};",
+            f"        while (x > {generate_expression(depth // 2, rng)}) {{",
+            f"            let x = x - 1;",
+            f"            do Output.printString(\"{name(i)} {i}\");",
+            "        }",
+            "        return x;",
+            "    }"
+        ]
+    lines.append("}")
+    with open(path, "w+") as file:
+        file.write("\n".join(lines) + "\n")
+    return path
+
+
+
+#====================== Stages ==========================
+def run_assembler(path):
+    with open(path, "r") as file:
+        words = list(MyAssembler.Parser()(file))
+    return len(words) * 2
+
+
+def run_vm_translator(path):
+    output = os.path.join(path, "out.asm")
+    codeWriter = VirtualMachine.CodeWriter(output)
+    codeWriter.writeInit()
+    for file in sorted(os.listdir(path)):
+        if file.endswith(".vm"):
+            VirtualMachine.translateFile(os.path.join(path, file), codeWriter)
+    codeWriter.close()
+    return os.path.getsize(output)
+
+
+def run_jack_tokenizer(path):
+    tokenizer = JackCompiler.Tokenizer(path)
+    numTokens = 0
+    while tokenizer.hasMoreTokens():
+        tokenizer.advance()
+        numTokens += 1
+    return numTokens
+
+
+def run_jack_compiler(path):
+    output = path.replace(".jack", ".vm")
+    vmWriter = JackCompiler.VMWriter(output)
+    JackCompiler.CompilationEngine(vmWriter, JackCompiler.Tokenizer(path)).compileClass()
+    vmWriter.close()
+    return os.path.getsize(output)
+
+
+def measure(stage, path, memory):
+    start = time.perf_counter()
+    outputSize = stage(path)
+    elapsed = time.perf_counter() - start
+
+    peak = None
+    if memory:
+        # a second run, tracing allocations would distort the timing of the first
+        tracemalloc.start()
+        stage(path)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return elapsed, peak, outputSize
+
+
+def input_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, file)) for file in os.listdir(path) if file.endswith(".vm"))
+    return os.path.getsize(path)
+
+
+def run_benchmarks(sizes, memory=True, seed=0):
+    rng = random.Random(seed)
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        workloads = []
+        for size in sizes["asm"]:
+            workloads.append(("assembler", size, run_assembler, generate_asm(directory, size, rng)))
+        for size in sizes["vm"]:
+            workloads.append(("vm_translator", size, run_vm_translator, generate_vm(directory, size, rng)))
+        for size in sizes["jack"]:
+            path = generate_jack(directory, size, rng)
+            workloads.append(("jack_tokenizer", size, run_jack_tokenizer, path))
+            workloads.append(("jack_compiler", size, run_jack_compiler, path))
+
+        for stageName, size, stage, path in workloads:
+            elapsed, peak, outputSize = measure(stage, path, memory)
+            result = {
+                "stage": stageName,
+                "size": size,
+                "input_bytes": input_size(path),
+                "seconds": round(elapsed, 4),
+                "throughput_bytes_per_s": round(input_size(path) / elapsed) if elapsed else None,
+                "peak_memory_bytes": peak,
+                "output_size": outputSize
+            }
+            results.append(result)
+            print(f"{stageName:<16} {size:>8} {elapsed:>9.3f}s {result['throughput_bytes_per_s'] or 0:>12} B/s "
+                  f"{(peak or 0) / 1e6:>8.1f} MB peak {outputSize:>10} out")
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(previous, results, threshold):
+    # a stage is a regression if it got slower by more than threshold against the last run of the same size
+    old = {(result["stage"], result["size"]): result for result in previous["results"]}
+    regressions = []
+    for result in results:
+        before = old.get((result["stage"], result["size"]))
+        if before and before["seconds"] and result["seconds"] > before["seconds"] * (1 + threshold):
+            regressions.append(f"{result['stage']} {result['size']}: {before['seconds']}s -> {result['seconds']}s")
+    return regressions
+
+
+def main():
+    flags = dict(arg[2:].split("=", 1) if "=" in arg else (arg[2:], "") for arg in sys.argv[1:] if arg.startswith("--"))
+    sizeName = flags.get("sizes", "quick")
+    historyPath = flags.get("history", os.path.join(ROOT, "benchmark", "history.json"))
+
+    results = run_benchmarks(SIZES[sizeName], "no-memory" not in flags)
+
+    history = []
+    if os.path.exists(historyPath):
+        with open(historyPath, "r") as file:
+            history = json.load(file)
+
+    previous = [entry for entry in history if entry["sizes"] == sizeName]
+    regressions = compare(previous[-1], results, float(flags.get("threshold", "0.2"))) if previous else []
+    for regression in regressions:
+        print("REGRESSION " + regression)
+
+    history.append({
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "sizes": sizeName,
+        "results": results
+    })
+    with open(historyPath, "w+") as file:
+        json.dump(history, file, indent=1)
+
+    if regressions and "fail-on-regression" in flags:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file